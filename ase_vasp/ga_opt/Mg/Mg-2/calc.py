@@ -1,5 +1,29 @@
 from ase.calculators.vasp import Vasp
-import os
+import json, os, signal, sys, threading, time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '..'))  # ase_vasp/
+from vasp_convergence import check_convergence, ionic_energies, oszicar_scf_steps
+
+
+# Stop relaxations that can no longer make it into the population (see EnergyWatcher)
+PRUNE = True
+PRUNE_MARGIN = 1.0  # eV above the worst member of the (full) population
+PRUNE_MIN_STEPS = 10  # ionic steps before a relaxation can be stopped
+PRUNE_WINDOW = 5  # ionic steps whose energy drop is extrapolated
+WATCH_INTERVAL = 30  # seconds between OSZICAR reads
+
+# Restart hung or non-converging runs from CONTCAR with safer settings (see StallWatcher)
+STALL_TIMEOUT = 2 * 3600  # seconds without any new OSZICAR line before VASP is killed
+MAX_NELM_HITS = 3  # consecutive ionic steps stopped by NELM before VASP is stopped
+ESCALATION_LADDER = [  # changes to vasp_calc() for each attempt
+    {},
+    {'algo': 'All'},
+    {'algo': 'All', 'potim': 0.05},
+    {'algo': 'All', 'potim': 0.02, 'nelm': 200},
+]
+# raw_score of a candidate for which every setting of ESCALATION_LADDER failed. It is stored
+# without an energy and with failed=True, so it counts as tested and never enters the population
+FAILED_RAW_SCORE = -1e10
 
 
 def vasp_calc(vasp_dir):
@@ -48,6 +72,150 @@ def vasp_calc(vasp_dir):
             )
     return calc
 
+def prune_energy(population_file):
+    """
+    Energy above which a candidate cannot enter the population: that of its
+    worst member, from the raw scores main_run.py writes to population_file
+    whenever the population changes. None while the population is not full.
+    """
+    try:
+        with open(population_file) as f:
+            population = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+    if len(population['raw_scores']) < population['size']:
+        return None
+    return -min(population['raw_scores'])
+
+
+class EnergyWatcher(threading.Thread):
+    """
+    Reads OSZICAR every interval seconds while VASP relaxes and writes a
+    STOPCAR (LSTOP: VASP finishes the current ionic step and exits cleanly)
+    once the relaxation clearly cannot end below prune_energy(population_file):
+    after min_steps ionic steps, the energy is more than margin above it and
+    dropped by less than that gap over the last window steps.
+    The energy at which it was stopped is kept in pruned_energy.
+    """
+    def __init__(self, vasp_dir, population_file, margin=PRUNE_MARGIN, min_steps=PRUNE_MIN_STEPS,
+                 window=PRUNE_WINDOW, interval=WATCH_INTERVAL):
+        super().__init__(daemon=True)
+        self.vasp_dir = vasp_dir
+        self.population_file = population_file
+        self.margin = margin
+        self.min_steps = max(min_steps, window + 1)
+        self.window = window
+        self.interval = interval
+        self.pruned_energy = None
+        self._stop_event = threading.Event()
+
+    def should_prune(self, energies):
+        if len(energies) < self.min_steps:
+            return False
+        e_max = prune_energy(self.population_file)
+        if e_max is None:
+            return False
+        gap = energies[-1] - e_max
+        return gap > self.margin and energies[-1 - self.window] - energies[-1] < gap
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            energies = ionic_energies(os.path.join(self.vasp_dir, 'OSZICAR'))
+            if self.should_prune(energies):
+                with open(os.path.join(self.vasp_dir, 'STOPCAR'), 'w') as f:
+                    f.write('LSTOP = .TRUE.\n')
+                self.pruned_energy = energies[-1]
+                print(f'Stopping relaxation at {energies[-1]} eV after {len(energies)} ionic steps: '
+                      f'cannot enter the population (worst member: {prune_energy(self.population_file)} eV)',
+                      flush=True)
+                return
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+def kill_children(sig=signal.SIGTERM):
+    """Sends sig to every descendant of this process (the shell, mpirun/srun and VASP started by ASE)"""
+    children = {}
+    for pid in filter(str.isdigit, os.listdir('/proc')):
+        try:
+            with open(f'/proc/{pid}/stat') as f:
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(pid))
+    stack = list(children.get(os.getpid(), []))
+    while stack:
+        pid = stack.pop()
+        stack.extend(children.get(pid, []))
+        try:
+            os.kill(pid, sig)
+        except ProcessLookupError:
+            pass
+
+
+class StallWatcher(threading.Thread):
+    """
+    Reads OSZICAR every interval seconds while VASP runs and ends the run if
+        - OSZICAR has not changed for stall_timeout seconds (hung run):
+          VASP is killed, reason = 'stalled'
+        - the last max_nelm_hits ionic steps all ran into NELM:
+          a STOPCAR stops VASP after the current ionic step, reason = 'nelm'
+    """
+    def __init__(self, vasp_dir, nelm, stall_timeout=STALL_TIMEOUT, max_nelm_hits=MAX_NELM_HITS,
+                 interval=WATCH_INTERVAL):
+        super().__init__(daemon=True)
+        self.vasp_dir = vasp_dir
+        self.nelm = nelm
+        self.stall_timeout = stall_timeout
+        self.max_nelm_hits = max_nelm_hits
+        self.interval = interval
+        self.reason = None
+        self._stop_event = threading.Event()
+
+    def run(self):
+        oszicar_path = os.path.join(self.vasp_dir, 'OSZICAR')
+        last_size, last_change = None, time.time()
+        while not self._stop_event.wait(self.interval):
+            size = os.path.getsize(oszicar_path) if os.path.exists(oszicar_path) else 0
+            if size != last_size:
+                last_size, last_change = size, time.time()
+            elif time.time() - last_change > self.stall_timeout:
+                self.reason = 'stalled'
+                print(f'No progress in OSZICAR for {self.stall_timeout} s. Killing VASP', flush=True)
+                kill_children()
+                return
+            if size == 0:
+                continue
+            n_scf = oszicar_scf_steps(oszicar_path)[0][-self.max_nelm_hits:]
+            if len(n_scf) == self.max_nelm_hits and min(n_scf) >= self.nelm:
+                self.reason = 'nelm'
+                print(f'The last {self.max_nelm_hits} ionic steps hit NELM = {self.nelm}. Stopping VASP', flush=True)
+                with open(os.path.join(self.vasp_dir, 'STOPCAR'), 'w') as f:
+                    f.write('LSTOP = .TRUE.\n')
+                return
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+def load_attempts(vasp_dir):
+    """Attempts made so far for this candidate (kept in vasp_dir so a resubmitted job continues the ladder)"""
+    try:
+        with open(os.path.join(vasp_dir, 'attempts.json')) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return []
+
+
+def save_attempts(vasp_dir, attempts):
+    os.makedirs(vasp_dir, exist_ok=True)
+    with open(os.path.join(vasp_dir, 'attempts.json'), 'w') as f:
+        json.dump(attempts, f, indent=1)
+
+
 def existing_contcar(vasp_dir):
     contcar_path = os.path.join(vasp_dir, "CONTCAR")
     if os.path.exists(contcar_path) and os.path.getsize(contcar_path) > 0:
@@ -56,32 +224,105 @@ def existing_contcar(vasp_dir):
         return None
 
 if __name__ == '__main__':
-    import sys
-
     from ase.io import read, write, trajectory
-    from pymatgen.io.vasp.outputs import Vasprun
 
 
     fname = sys.argv[1]
     a = read(fname)
     vasp_dir = f'./{fname[:-5]}-vasp'
 
-    # check if we can resume from a previously terminated job
-    contcar_path = existing_contcar(vasp_dir)
-    if contcar_path is not None:
-        contcar = read(contcar_path)
-        a.positions = contcar.positions
-        a.cell = contcar.cell
-        traj = trajectory.Trajectory(fname, 'w')
-        traj.write(a)
-        traj.close()
+    stopcar_path = os.path.join(vasp_dir, 'STOPCAR')
+    attempts = load_attempts(vasp_dir)
+    if attempts and attempts[-1]['outcome'] == 'running':
+        attempts[-1]['outcome'] = 'terminated'  # the job was killed (e.g. wall time)
+
+    pruned_energy = None
+    energy = None
+    while True:
+        # check if we can resume from a previously terminated job (or attempt)
+        contcar_path = existing_contcar(vasp_dir)
+        if contcar_path is not None:
+            contcar = read(contcar_path)
+            a.positions = contcar.positions
+            a.cell = contcar.cell
+            traj = trajectory.Trajectory(fname, 'w')
+            traj.write(a)
+            traj.close()
+
+        if os.path.exists(stopcar_path):
+            os.remove(stopcar_path)  # left over from a previous run
+        oszicar_path = os.path.join(vasp_dir, 'OSZICAR')
+        if os.path.exists(oszicar_path):
+            # kept for reference; the watchers must only see this attempt's progress and energies
+            os.replace(oszicar_path, os.path.join(vasp_dir, f'OSZICAR.{len(attempts)}'))
+
+        # a terminated attempt is repeated with the same settings
+        failed = [at for at in attempts if at['outcome'] in ('stalled', 'nelm', 'error')]
+        settings = ESCALATION_LADDER[min(len(failed), len(ESCALATION_LADDER) - 1)]
+        print(f'Now relaxing {fname} (attempt {len(attempts) + 1}, settings {settings})', flush=True)
+        attempts.append({'settings': settings, 'outcome': 'running', 'start': time.time()})
+        save_attempts(vasp_dir, attempts)
 
-    print(f'Now relaxing {fname}')
+        calc = vasp_calc(vasp_dir)
+        calc.set(**settings)
+        a.calc = calc
+        stall_watcher = StallWatcher(vasp_dir, calc.int_params.get('nelm') or 60)
+        stall_watcher.start()
+        if PRUNE:
+            watcher = EnergyWatcher(vasp_dir, os.path.join(os.path.dirname(fname), 'population.json'))
+            watcher.start()
+        error = None
+        try:
+            energy = a.get_potential_energy()
+        except Exception as e:
+            error = e
+        finally:
+            stall_watcher.stop()
+            if PRUNE:
+                watcher.stop()
 
-    a.calc = vasp_calc(vasp_dir)
-    a.info['key_value_pairs']['raw_score'] = -a.get_potential_energy()
+        attempts[-1]['end'] = time.time()
+        attempts[-1]['n_ionic'] = len(ionic_energies(oszicar_path))
+        if PRUNE and watcher.pruned_energy is not None:
+            attempts[-1]['outcome'] = 'pruned'
+            pruned_energy = watcher.pruned_energy
+        elif stall_watcher.reason is not None:
+            attempts[-1]['outcome'] = stall_watcher.reason
+        elif error is not None:
+            attempts[-1]['outcome'] = 'error'
+            attempts[-1]['error'] = str(error)
+        else:
+            attempts[-1]['outcome'] = 'done'
+        save_attempts(vasp_dir, attempts)
+        print(f"Attempt {len(attempts)}: {attempts[-1]['outcome']}", flush=True)
+
+        if attempts[-1]['outcome'] in ('done', 'pruned'):
+            break
+        if len(failed) + 1 >= len(ESCALATION_LADDER):
+            if energy is None:
+                print(f"Every setting of ESCALATION_LADDER failed ({error}). Recording {fname} as failed.",
+                      flush=True)
+            else:
+                print("Every setting of ESCALATION_LADDER failed. Keeping the last energy.", flush=True)
+            break
+        energy = None
+
+    if os.path.exists(stopcar_path):
+        os.remove(stopcar_path)
+    if energy is None:
+        a.calc = None  # no energy to store
+        a.info['key_value_pairs']['raw_score'] = FAILED_RAW_SCORE
+        a.info['key_value_pairs']['failed'] = True
+    else:
+        a.info['key_value_pairs']['raw_score'] = -energy
+    a.info['key_value_pairs']['n_attempts'] = len(attempts)
+    a.info.setdefault('data', {})['attempts'] = attempts
+    if pruned_energy is not None:
+        # recorded with the partial energy, so it never enters the population
+        a.info['key_value_pairs']['pruned'] = True
+        a.info['key_value_pairs']['pruned_energy'] = pruned_energy
 
-    if Vasprun(os.path.join(vasp_dir, "vasprun.xml")).converged_electronic:
+    if check_convergence(vasp_dir)['converged_electronic']:
         print("Converged!")
     else:
         print("Failed to converge.")
@@ -0,0 +1,148 @@
+"""
+Lower convex hull of the formation energy over all compositions (Mg-$i), and
+the energy above it of any number of candidates.
+
+For ion count n (0 ... n_full), the formation energy of a structure is
+    E_f = E - (ref_full * n / n_full + ref_empty * (n_full - n) / n_full)
+as in extract_ga_energy. Only the lowest E_f of each count can be on the
+hull, so ConvexHull keeps those minima and recomputes the hull (at most
+n_full + 1 points) only when one of them drops. The energies above the hull
+of any array of candidates are then a single np.interp call.
+
+HullFeed keeps a ConvexHull up to date from the gadb.db files, reading only
+the rows added since its last update. Used by main_run.py (HULL_SCORE),
+main_run_all.py (HULL_FOCUS) and plot_convex_hull.py.
+"""
+import os
+import sqlite3
+
+import numpy as np
+
+from monitor_ga import NEW_RELAXED_ROWS
+
+
+class ConvexHull:
+    """
+    Args:
+        ref_empty, ref_full (float): energies of the empty and full structure (eV)
+        n_full (int): number of ions when the structure is full
+    """
+    def __init__(self, ref_empty, ref_full, n_full):
+        self.ref_empty = ref_empty
+        self.ref_full = ref_full
+        self.n_full = n_full
+        self.reset()
+
+    def reset(self):
+        self.minima = {}  # ion count -> lowest formation energy
+        self._update_vertices()
+
+    def reference_energy(self, counts):
+        counts = np.asarray(counts, float)
+        return self.ref_full * counts / self.n_full + self.ref_empty * (self.n_full - counts) / self.n_full
+
+    def formation_energy(self, counts, energies):
+        return np.asarray(energies, float) - self.reference_energy(counts)
+
+    def _update_vertices(self):
+        points = {0: 0., self.n_full: 0.}  # the references
+        for n, e_f in self.minima.items():
+            points[n] = min(e_f, points.get(n, np.inf))
+        hull = []
+        for point in sorted(points.items()):  # lower hull of Andrew's monotone chain
+            while len(hull) >= 2 and ((hull[-1][0] - hull[-2][0]) * (point[1] - hull[-2][1]) -
+                                      (hull[-1][1] - hull[-2][1]) * (point[0] - hull[-2][0])) <= 0:
+                hull.pop()
+            hull.append(point)
+        self.vertices = np.array(hull, float)  # [(ion count, formation energy)] from left to right
+
+    def add(self, counts, energies):
+        """Adds candidates (ion counts and total energies, eV). Returns whether the hull changed."""
+        counts = np.asarray(counts, int)
+        e_f = self.formation_energy(counts, energies)
+        finite = np.isfinite(e_f)
+        counts, e_f = counts[finite], e_f[finite]
+        dropped = False
+        for n in np.unique(counts):
+            lowest = e_f[counts == n].min()
+            if lowest < self.minima.get(int(n), np.inf):
+                self.minima[int(n)] = lowest
+                dropped = True
+        if not dropped:
+            return False
+        old = self.vertices
+        self._update_vertices()
+        return old.shape != self.vertices.shape or not np.allclose(old, self.vertices)
+
+    def hull_energy(self, counts):
+        """Formation energy of the hull at each ion count"""
+        return np.interp(np.asarray(counts, float), self.vertices[:, 0], self.vertices[:, 1])
+
+    def e_above_hull(self, counts, energies):
+        """Energy above the hull (eV, >= 0 for all candidates added so far) of each candidate"""
+        return self.formation_energy(counts, energies) - self.hull_energy(counts)
+
+    def best_e_above_hull(self, count):
+        """Energy above the hull of the lowest candidate with this ion count, or None if there is none."""
+        if count not in self.minima:
+            return None
+        return float(self.minima[count] - self.hull_energy(count))
+
+
+class HullFeed:
+    """
+    Feeds the relaxed candidates of several gadb.db files to a ConvexHull,
+    reading only the rows added since the last update (by row id). If rows
+    were deleted (e.g. clean_kids_from_db.py), the hull is rebuilt.
+
+    Args:
+        hull (ConvexHull)
+        db_paths (dict): {ion count: path of its gadb.db}
+    """
+    def __init__(self, hull, db_paths):
+        self.hull = hull
+        self.db_paths = db_paths
+        self.last_ids = {n: 0 for n in db_paths}  # highest row id read from each database
+
+    def _new_rows(self, path, last_id):
+        """Returns the new rows, or None if the row last_id was deleted."""
+        con = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+        try:
+            if last_id > 0 and con.execute('SELECT 1 FROM systems WHERE id = ?', (last_id,)).fetchone() is None:
+                return None
+            return con.execute(NEW_RELAXED_ROWS, (last_id,)).fetchall()
+        finally:
+            con.close()
+
+    def update(self):
+        """Reads the candidates relaxed since the last call. Returns whether the hull changed."""
+        new_rows = {}
+        for n, path in self.db_paths.items():
+            if not os.path.isfile(path):
+                continue
+            rows = self._new_rows(path, self.last_ids[n])
+            if rows is None:  # rebuild from scratch
+                self.hull.reset()
+                self.last_ids = {n: 0 for n in self.db_paths}
+                return self.update() or True
+            new_rows[n] = rows
+
+        counts, energies = [], []
+        for n, rows in new_rows.items():
+            if rows:
+                self.last_ids[n] = rows[-1][0]
+            energies += [energy for row_id, energy in rows if energy is not None]
+            counts += [n] * (len(energies) - len(counts))
+        return self.hull.add(counts, energies) if energies else False
+
+
+def sibling_databases(run_dir):
+    """{ion count: gadb.db} of the Mg-$j directories next to run_dir (Mg-$i)"""
+    run_dir = os.path.abspath(run_dir)
+    prefix = os.path.basename(run_dir).rsplit('-', 1)[0]
+    db_paths = {}
+    for name in os.listdir(os.path.dirname(run_dir)):
+        head, _, count = name.rpartition('-')
+        if head == prefix and count.isdigit():
+            db_paths[int(count)] = os.path.join(os.path.dirname(run_dir), name, 'gadb.db')
+    return db_paths
@@ -0,0 +1,145 @@
+"""
+Persistent index of structural fingerprints used by main_run.py to skip
+offspring that duplicate a candidate that is already relaxed or queued.
+
+The fingerprint of a structure is what InteratomicDistanceComparator (comp in
+main_run.py) compares: for each element among the atoms being optimized (the
+last n_top), the sorted distances between the atoms of that element, with the
+same mic setting. Two structures are duplicates under the same criteria as
+its structural test (there is no energy before the relaxation, so dE is not
+used):
+    sum over elements of sum|d1 - d2| / sum(d1) * (atoms of the element / n_top) < cum_diff
+    and max|d1 - d2| < max_diff
+where, as in ASE, max|d1 - d2| is that of the last element with any pairs.
+
+The fingerprints are kept in an SQLite file next to gadb.db and indexed by a
+bucket of the mean distance of the most common element on a log scale. The
+cum_diff criterion bounds how much that mean can differ between duplicates,
+so only candidates in the same and the two neighboring buckets are ever
+compared, instead of all of them. Identical fingerprints are found by their
+hash alone.
+"""
+import hashlib
+import json
+import sqlite3
+
+import numpy as np
+
+
+def pair_distances(atoms, n_top, mic=False):
+    """
+    {atomic number: sorted distances between the atoms of that element} among
+    the last n_top atoms, in the order of get_sorted_dist_list (which
+    InteratomicDistanceComparator uses), but from one distance matrix.
+    """
+    top = atoms[len(atoms) - n_top:]
+    distances = top.get_all_distances(mic=mic)
+    pairs = {}
+    for number in set(top.numbers):
+        index = np.flatnonzero(top.numbers == number)
+        pairs[int(number)] = np.sort(distances[np.ix_(index, index)][np.triu_indices(len(index), 1)])
+    return pairs
+
+
+def structure_difference(p1, p2, n_top):
+    """(cum_diff, max_diff) of two pair_distances(), as InteratomicDistanceComparator computes them."""
+    total_cum_diff = 0.
+    max_diff = 0.
+    for number, c1 in p1.items():
+        c2 = p2[number]
+        if len(c1) == 0:
+            continue
+        d = np.abs(c1 - c2)
+        max_diff = d.max()  # of the last element with pairs, as in ASE
+        n_type = (1 + np.sqrt(1 + 8 * len(c1))) / 2  # atoms of this element, from its number of pairs
+        total_cum_diff += d.sum() / c1.sum() * n_type / n_top
+    return total_cum_diff, max_diff
+
+
+class FingerprintIndex:
+    """
+    Args:
+        path (str): SQLite file of the index (e.g. gadb_fingerprints.db)
+        n_top (int): number of atoms being optimized (the last ones)
+        cum_diff, max_diff (float): duplicate tolerances (see module docstring)
+        mic (bool): minimum image convention for the distances, as in comp
+    """
+    def __init__(self, path, n_top, cum_diff=0.015, max_diff=0.7, mic=False):
+        self.n_top = n_top
+        self.cum_diff = cum_diff
+        self.max_diff = max_diff
+        self.mic = mic
+        self.con = sqlite3.connect(path)
+        self.con.execute('CREATE TABLE IF NOT EXISTS pair_distances '
+                         '(confid INTEGER, relaxed INTEGER, mic INTEGER, elements TEXT, bucket INTEGER, '
+                         'digest TEXT, distances BLOB, PRIMARY KEY (confid, relaxed))')
+        self.con.execute('CREATE INDEX IF NOT EXISTS bucket_index ON pair_distances (mic, elements, bucket)')
+        self.con.execute('CREATE INDEX IF NOT EXISTS digest_index ON pair_distances (digest)')
+        self.con.commit()
+
+    def _bucket(self, pairs):
+        # the element with the most atoms weighs most in cum_diff: for duplicates, its
+        # sum of distances differs by less than a factor 1 + c, with c = cum_diff / weight
+        number = max(pairs, key=lambda n: len(pairs[n]))
+        if len(pairs[number]) == 0:
+            return 0
+        n_type = (1 + np.sqrt(1 + 8 * len(pairs[number]))) / 2
+        c = self.cum_diff * self.n_top / n_type
+        if c >= 1:
+            return 0  # no bound
+        # at most one bucket apart, since 1 + c < 1 / (1 - c)
+        return int(np.floor(np.log(pairs[number].mean()) / -np.log1p(-c)))
+
+    def _row(self, confid, relaxed, atoms):
+        pairs = pair_distances(atoms, self.n_top, self.mic)
+        elements = json.dumps([[n, len(d)] for n, d in pairs.items()])  # in order, to split the blob again
+        blob = np.concatenate(list(pairs.values())).tobytes()
+        return (int(confid), int(relaxed), int(self.mic), elements, self._bucket(pairs),
+                hashlib.sha1(np.round(np.frombuffer(blob), 8).tobytes()).hexdigest(), blob)
+
+    @staticmethod
+    def _pairs(elements, blob):
+        distances = np.frombuffer(blob)
+        pairs = {}
+        start = 0
+        for number, n_pairs in json.loads(elements):
+            pairs[number] = distances[start:start + n_pairs]
+            start += n_pairs
+        return pairs
+
+    def add(self, atoms, relaxed=False):
+        """Adds (or replaces) the fingerprint of a candidate with confid in atoms.info."""
+        self.con.execute('INSERT OR REPLACE INTO pair_distances VALUES (?, ?, ?, ?, ?, ?, ?)',
+                         self._row(atoms.info['confid'], relaxed, atoms))
+        self.con.commit()
+
+    def update(self, candidates, relaxed=True):
+        """Adds the candidates that are not in the index yet. Returns how many were added."""
+        known = {confid for (confid,) in self.con.execute(
+            'SELECT confid FROM pair_distances WHERE relaxed = ? AND mic = ?', (int(relaxed), int(self.mic)))}
+        rows = [self._row(a.info['confid'], relaxed, a) for a in candidates if a.info['confid'] not in known]
+        self.con.executemany('INSERT OR REPLACE INTO pair_distances VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+        self.con.commit()
+        return len(rows)
+
+    def find_duplicate(self, atoms):
+        """Returns the confid of an indexed candidate within tolerance of atoms, or None."""
+        confid = atoms.info.get('confid')
+        confid, relaxed, mic, elements, bucket, digest, blob = self._row(-1 if confid is None else confid,
+                                                                         False, atoms)
+        for (match,) in self.con.execute('SELECT confid FROM pair_distances '
+                                         'WHERE digest = ? AND mic = ? AND elements = ? AND confid != ?',
+                                         (digest, mic, elements, confid)):
+            return match
+        pairs = self._pairs(elements, blob)
+        for match, other in self.con.execute(
+                'SELECT confid, distances FROM pair_distances '
+                'WHERE mic = ? AND elements = ? AND bucket BETWEEN ? AND ? AND confid != ?',
+                (mic, elements, bucket - 1, bucket + 1, confid)):
+            cum_diff, max_diff = structure_difference(pairs, self._pairs(elements, other), self.n_top)
+            if cum_diff < self.cum_diff and max_diff < self.max_diff:
+                return match
+        return None
+
+    def close(self):
+        self.con.close()
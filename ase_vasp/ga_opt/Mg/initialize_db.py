@@ -1,24 +1,232 @@
 import numpy as np
 import copy
+import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import zip_longest
 
 from ase.build import fcc111
 from ase.constraints import FixAtoms
-from ase.ga.data import PrepareDB
+from ase.ga.data import DataConnection, PrepareDB
 from ase.ga.startgenerator import StartGenerator
 from ase.ga.utilities import closest_distances_generator, get_all_atom_types
+from ase.geometry import get_distances
 from ase.io import read
 from ase.atom import Atom
 import ase.data
-from ase.geometry import get_distances
 
 
-def main(n_atoms, element):
-    db_file = 'gadb.db'
+class CellListSampler:
+    """
+    Rejection sampler that places atoms at uniformly random positions in a
+    periodic cell, rejecting positions closer than blmin to any existing atom.
+    The placement volume is given by a corner position p0 and three spanning
+    vectors box = (v1, v2, v3), and defaults to the whole cell.
+
+    Atoms are binned into a cell list with bins at least max(blmin) wide, so a
+    trial position is only compared with atoms in its 27 neighboring bins.
+    Trial positions are drawn and tested in vectorized batches.
+    """
+    def __init__(self, atoms, blmin, p0=None, box=None, rng=None,
+                 batch_size=512, max_trials=100000):
+        self.cell = np.array(atoms.get_cell())
+        self.p0 = np.zeros(3) if p0 is None else np.asarray(p0)
+        self.box = self.cell if box is None else np.asarray(box)
+        self.inv_cell = np.linalg.inv(self.cell)
+        self.pbc = np.array(atoms.get_pbc(), dtype=bool)
+        self.rng = np.random.default_rng() if rng is None else rng
+        self.batch_size = batch_size
+        self.max_trials = max_trials  # per placed atom
+
+        # blmin as a lookup table indexed by atomic numbers
+        z_max = max(max(pair) for pair in blmin) + 1
+        self.radii = np.zeros((z_max, z_max))
+        for (z1, z2), r in blmin.items():
+            self.radii[z1, z2] = r
+
+        # bins at least as wide as the largest exclusion radius
+        cutoff = max(blmin.values())
+        volume = abs(np.linalg.det(self.cell))
+        widths = volume / np.linalg.norm(np.cross(self.cell[[1, 2, 0]], self.cell[[2, 0, 1]]), axis=1)
+        if np.any(2 * cutoff > widths[self.pbc]):
+            raise ValueError(f"Largest blmin {cutoff} is more than half the cell width {widths.min():.3f}")
+        self.n_bins = np.maximum(np.floor(widths / cutoff).astype(int), 1)
+        self.shifts = np.array([(i, j, k) for i in (-1, 0, 1) for j in (-1, 0, 1) for k in (-1, 0, 1)])
+        self.bin_atoms = -np.ones((np.prod(self.n_bins), 8), dtype=int)  # atom indices per bin, -1 padded
+        self.bin_count = np.zeros(np.prod(self.n_bins), dtype=int)
+
+        self.positions = np.empty((0, 3))
+        self.numbers = np.empty(0, dtype=int)
+        self.add(atoms.get_positions(), atoms.get_atomic_numbers())
+
+        self.buffer = np.empty((0, 3))  # trial positions not tested yet
+        self.n_trials = 0
+        self.n_accepted = 0
+
+    def _bin_indices(self, positions):
+        frac = positions @ self.inv_cell
+        frac[..., self.pbc] %= 1.0
+        idx = np.floor(frac * self.n_bins).astype(int)
+        return np.clip(idx, 0, self.n_bins - 1)
+
+    def add(self, positions, numbers):
+        positions = np.atleast_2d(positions)
+        numbers = np.atleast_1d(numbers)
+        first = len(self.positions)
+        self.positions = np.vstack([self.positions, positions])
+        self.numbers = np.concatenate([self.numbers, numbers])
+        flat = np.ravel_multi_index(self._bin_indices(positions).T, self.n_bins)
+        for i, b in enumerate(flat, start=first):
+            if self.bin_count[b] == self.bin_atoms.shape[1]:
+                self.bin_atoms = np.hstack([self.bin_atoms, -np.ones_like(self.bin_atoms)])
+            self.bin_atoms[b, self.bin_count[b]] = i
+            self.bin_count[b] += 1
+
+    def acceptable(self, trials, number):
+        """Mask of trial positions (N, 3) that are at least blmin away from every atom (with PBC)."""
+        idx = self._bin_indices(trials)[:, np.newaxis, :] + self.shifts  # (N, 27, 3)
+        idx[..., self.pbc] %= self.n_bins[self.pbc]
+        inside = np.all((idx >= 0) & (idx < self.n_bins), axis=-1)
+        idx = np.clip(idx, 0, self.n_bins - 1)
+        flat = np.ravel_multi_index(tuple(np.moveaxis(idx, -1, 0)), self.n_bins)
+
+        neighbors = self.bin_atoms[flat]  # (N, 27, max atoms per bin)
+        valid = (neighbors >= 0) & inside[..., np.newaxis]
+        d_frac = (self.positions[neighbors] - trials[:, np.newaxis, np.newaxis, :]) @ self.inv_cell
+        d_frac[..., self.pbc] -= np.round(d_frac[..., self.pbc])
+        dist = np.linalg.norm(d_frac @ self.cell, axis=-1)
+        too_close = valid & (dist < self.radii[number, self.numbers[neighbors]])
+        return ~too_close.any(axis=(1, 2))
+
+    def place(self, number):
+        """Places one atom with the given atomic number and returns its position."""
+        n_tried = 0
+        while True:
+            if len(self.buffer) == 0:
+                if n_tried >= self.max_trials:
+                    raise RuntimeError(f"Could not place atom {ase.data.chemical_symbols[number]} "
+                                       f"after {n_tried} trials. No free volume left for blmin.")
+                self.buffer = self.p0 + self.rng.random((self.batch_size, 3)) @ self.box
+            ok = np.flatnonzero(self.acceptable(self.buffer, number))
+            if len(ok) == 0:
+                n_tried += len(self.buffer)
+                self.n_trials += len(self.buffer)
+                self.buffer = np.empty((0, 3))
+                continue
+            i = ok[0]  # first acceptable trial, same as testing one at a time
+            pos = self.buffer[i]
+            self.buffer = self.buffer[i + 1:]
+            self.n_trials += i + 1
+            self.n_accepted += 1
+            self.add(pos, number)
+            return pos
+
+    @property
+    def acceptance_rate(self):
+        return self.n_accepted / max(self.n_trials, 1)
+
+
+def best_relaxed(db_file, n_best):
+    """Up to n_best relaxed candidates of db_file (highest raw_score first, not failed), or [] if it does not exist."""
+    if not os.path.isfile(db_file):
+        return []
+    return DataConnection(db_file).get_all_relaxed_candidates(use_extinct=True)[:n_best]
+
+
+def insertion_sites(atoms, blmin, number, n_sites, rng, n_trials=2048):
+    """
+    Up to n_sites positions for one more atom (atomic number) in atoms, where
+    there is the most free volume: random positions at least blmin away from
+    every atom, ranked by their clearance (distance to the nearest atom minus
+    blmin), and at least blmin apart from each other.
+    """
+    sampler = CellListSampler(atoms, blmin, rng=rng)
+    trials = rng.random((n_trials, 3)) @ sampler.cell
+    trials = trials[sampler.acceptable(trials, number)]
+    if len(trials) == 0:
+        return []
+    _, dist = get_distances(trials, atoms.positions, cell=atoms.cell, pbc=atoms.pbc)
+    clearance = (dist - sampler.radii[number, atoms.numbers]).min(axis=1)
+    sites = []
+    for k in np.argsort(-clearance):
+        if sites:
+            _, d = get_distances(trials[k], np.array(sites), cell=atoms.cell, pbc=atoms.pbc)
+            if d.min() < blmin[(number, number)]:
+                continue
+        sites.append(trials[k])
+        if len(sites) == n_sites:
+            break
+    return sites
+
+
+def crowded_atoms(atoms, blmin, n_top):
+    """Indices of the last n_top atoms, with the least free volume (distance to the nearest atom minus blmin) first."""
+    top = np.arange(len(atoms) - n_top, len(atoms))
+    _, dist = get_distances(atoms.positions[top], atoms.positions, cell=atoms.cell, pbc=atoms.pbc)
+    dist[np.arange(n_top), top] = np.inf
+    radii = np.array([[blmin[(atoms.numbers[i], z)] for z in atoms.numbers] for i in top])
+    return top[np.argsort((dist - radii).min(axis=1))]
+
+
+def warm_start_candidates(skeleton, n_atoms, element, run_dir, blmin, n_candidates, rng=None):
+    """
+    Up to n_candidates starting structures for n_atoms atoms of element, made
+    from the best relaxed candidates of the neighboring compositions
+    {element}-{n_atoms - 1} (one atom inserted where there is the most free
+    volume) and {element}-{n_atoms + 1} (the most crowded atom removed).
+    Returns [(atoms, 'Mg-4:12')] with the directory and confid of the parent.
+    """
+    rng = np.random.default_rng() if rng is None else rng
+    number = ase.data.atomic_numbers[element]
+    parent_dir = os.path.dirname(os.path.abspath(run_dir))
+    neighbors = []
+    for n_parent in (n_atoms - 1, n_atoms + 1):
+        name = f"{element}-{n_parent}"
+        relaxed = best_relaxed(os.path.join(parent_dir, name, 'gadb.db'), n_candidates) if n_parent > 0 else []
+        neighbors.append([(n_parent, name, parent) for parent in relaxed
+                          if len(parent) == len(skeleton) + n_parent])
+    parents = [p for pair in zip_longest(*neighbors) for p in pair if p is not None]  # alternating, best first
+    if not parents:
+        return []
+    per_parent = -(-n_candidates // len(parents))
+
+    candidates = []
+    for n_parent, name, parent in parents:
+        # the skeleton (with its constraints) at the relaxed positions and cell of the parent
+        a = copy.deepcopy(skeleton)
+        a.set_cell(parent.get_cell())
+        a.positions = parent.positions[:len(skeleton)]
+        for pos in parent.positions[len(skeleton):]:
+            a.append(Atom(number, position=pos))
+        source = f"{name}:{parent.info['confid']}"
+        if n_parent < n_atoms:
+            for pos in insertion_sites(a, blmin, number, per_parent, rng):
+                b = a.copy()
+                b.append(Atom(number, position=pos))
+                candidates.append((b, source))
+        else:
+            for i in crowded_atoms(a, blmin, n_parent)[:per_parent]:
+                b = a.copy()
+                del b[i]
+                candidates.append((b, source))
+    return candidates[:n_candidates]
+
+
+def main(n_atoms, element, run_dir='.', rng=None, warm_start=False, warm_fraction=0.5):
+    """
+    Creates run_dir/gadb.db with the starting population for n_atoms atoms of
+    element. Never changes the working directory. Pass a seeded
+    np.random.Generator as rng for a reproducible population.
+
+    With warm_start, up to warm_fraction of the population is built from the
+    relaxed structures of the neighboring compositions, if they have any (see
+    warm_start_candidates). The rest is placed randomly.
+    """
+    db_file = os.path.join(run_dir, 'gadb.db')
     atom_comp = n_atoms * [element]  # composition of atoms to add
     atom_numbers = [ase.data.atomic_numbers[e] for e in atom_comp]
 
     # import the skeleton
-    skeleton = read('../../POSCAR')
+    skeleton = read(os.path.join(run_dir, '../../POSCAR'))
 
     # define the volume in which atoms are placed
     # the volume is defined by a corner position (p0)
@@ -41,36 +249,81 @@ def main(n_atoms, element):
 
     # generate the starting population
     population_size = 20
-    for i in range(population_size):  # each new structure
+    n_warm = 0
+    if warm_start:
+        for a, source in warm_start_candidates(skeleton, n_atoms, element, run_dir, blmin,
+                                               int(round(warm_fraction * population_size)), rng=rng):
+            d.add_unrelaxed_candidate(a, warm_start=source)
+            n_warm += 1
+        print(f"{run_dir}: {n_warm} candidates from neighboring compositions")
+    n_trials = 0
+    n_accepted = 0
+    for i in range(population_size - n_warm):  # each new structure
         a = copy.deepcopy(skeleton)
-        for j, atom_number in enumerate(atom_numbers):  # each atom to add
-            acceptable = False
-            while not acceptable:
-                pos = p0 + np.random.rand()*v1 + np.random.rand()*v2 + np.random.rand()*v3
-                pos = pos[np.newaxis, :]  # make 2D
-                for atom in a:
-                    pos_atom = atom.position[np.newaxis, :]
-                    _, dist = get_distances(pos, pos_atom, cell=a.cell, pbc=a.pbc)  # with PBC
-                    ituple = (atom_number, atom.number)
-                    if dist < blmin[ituple]:
-                        acceptable = False
-                        break
-                    else:
-                        acceptable = True
-            a.append(Atom(atom_number, position=pos[0]))
+        sampler = CellListSampler(a, blmin, p0=p0, box=[v1, v2, v3], rng=rng)
+        for atom_number in atom_numbers:  # each atom to add
+            pos = sampler.place(atom_number)
+            a.append(Atom(atom_number, position=pos))
+        n_trials += sampler.n_trials
+        n_accepted += sampler.n_accepted
         d.add_unrelaxed_candidate(a)
+    print(f"{run_dir}: acceptance rate {n_accepted}/{n_trials} ({n_accepted / max(n_trials, 1):.1%})")
 
 
-if __name__ == '__main__':
-    import os
+def build_composition(n_atoms, element, seed_sequence, warm_start=False):
+    """
+    Worker: creates directory {element}-{n_atoms} and its gadb.db with its own
+    random stream. With warm_start, the directory may already exist (e.g. with
+    calc.py copied in), but not its gadb.db.
+    """
+    dir_name = f"{element}-{n_atoms}"
+    if warm_start:
+        os.makedirs(dir_name, exist_ok=True)
+        if os.path.exists(os.path.join(dir_name, 'gadb.db')):
+            raise FileExistsError(os.path.join(dir_name, 'gadb.db'))
+    else:
+        os.mkdir(dir_name)
+    main(n_atoms, element, run_dir=dir_name, rng=np.random.default_rng(seed_sequence), warm_start=warm_start)
+    return dir_name
 
+
+def initialize_all(element, ion_counts, seed=None, max_workers=None, warm_start=False):
+    """
+    Builds every composition's gadb.db concurrently in a process pool.
+
+    With warm_start, compositions that already have a gadb.db are skipped and
+    the others are built one after another, each partly seeded from the
+    relaxed candidates of its neighbors (see main). Only neighbors that were
+    relaxed before this call have any, so a composition next to new ones only
+    gets random candidates.
+
+    Each composition gets an independent child of np.random.SeedSequence(seed),
+    so the same seed always gives the same starting populations, regardless of
+    the number of workers or the order in which they finish.
+    """
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+    print(f"Seed: {seed}")
+    seed_sequences = np.random.SeedSequence(seed).spawn(len(ion_counts))
+
+    if warm_start:
+        # in order, so no neighbor database is read while another process writes it
+        for i, ss in zip(ion_counts, seed_sequences):
+            if os.path.exists(os.path.join(f"{element}-{i}", 'gadb.db')):
+                print(f"Skipping {element}-{i}: gadb.db already exists")
+                continue
+            print(f"Done: {build_composition(i, element, ss, warm_start=True)}")
+        return
+
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        futures = [pool.submit(build_composition, i, element, ss)
+                   for i, ss in zip(ion_counts, seed_sequences)]
+        for future in futures:
+            print(f"Done: {future.result()}")
+
+
+if __name__ == '__main__':
     element = 'Mg'
-    for i in range(1, 13):
-        dir_name = f"{element}-{i}"
-        print(dir_name)
-        os.mkdir(dir_name)  # Create the directory
-        
-        os.chdir(dir_name)  # Change into the new directory
-        main(i, element)    # Run main() inside the new directory
-        
-        os.chdir('..')  # Return to the original directory
+    seed = None  # set to the printed seed of a previous run to reproduce it
+    warm_start = False  # seed from the relaxed structures of {element}-(n-1) and {element}-(n+1) where they exist
+    initialize_all(element, range(1, 13), seed=seed, warm_start=warm_start)
@@ -1,11 +1,16 @@
 from random import random
 from itertools import chain
-import time, os, socket, sys
+import asyncio, json, os, socket, sys, threading, time
 
 from ase.ga.cutandsplicepairing import CutAndSplicePairing
 from ase.ga.data import DataConnection
 from ase.ga.offspring_creator import OperationSelector
 from slurmqueuerun import SLURMQueueRun
+from prerelax import check_calculator, prerelax
+from surrogate import KernelRidgeSurrogate, PairDistanceFingerprint
+from fingerprint_index import FingerprintIndex
+from offspring_buffer import OffspringBuffer, ProducerStarved
+from convex_hull import ConvexHull, HullFeed, sibling_databases
 from ase.ga.population import Population
 from ase.ga.standard_comparators import InteratomicDistanceComparator
 from ase.ga.standardmutations import (
@@ -14,16 +19,18 @@ from ase.ga.standardmutations import (
     RattleMutation,
 )
 from ase.ga.utilities import closest_distances_generator, get_all_atom_types
+from ase.ga import get_raw_score
 from ase.io import write
 from ase.db import connect
+import numpy as np
 
 
 
-def jtg(job_name, traj_file):
+def job_header(job_name):
     s = '#!/bin/bash\n'
     s += '\n'
     s += f'#SBATCH --job-name {job_name}\n'
-    s += '#SBATCH --nodes=1\n'  # per structure
+    s += '#SBATCH --nodes=1\n'  # per structure (or per pack of PACK_SIZE structures)
     s += '#SBATCH --ntasks-per-node=128\n'
     s += '#SBATCH --partition=wholenode\n'
     s += '#SBATCH --time=96:00:00\n'
@@ -35,172 +42,444 @@ def jtg(job_name, traj_file):
     s += 'ml load intel-mkl\n'
     s += 'export PATH=/home/x-graeme/vasp/vasp.6.4.3/bin:$PATH\n'
     s += 'export VASP_PP_PATH="/anvil/scratch/x-sjung3/prussian_blue/vasp_potpaws"\n'
+    return s
+
+
+def jtg(job_name, traj_file):
+    s = job_header(job_name)
     s += 'export ASE_VASP_COMMAND="mpirun -np $SLURM_NTASKS vasp_std"\n'
     s += f'python calc.py {traj_file}\n'
     s += 'date\n'
     return s
 
 
+def pack_jtg(job_name, runner_command):
+    """Allocation that runs PACK_SIZE candidates at once (see pack_runner.py)"""
+    s = job_header(job_name)
+    s += 'export ASE_VASP_COMMAND="srun --exact -n {ranks} vasp_std"\n'  # {ranks} is filled in by pack_runner.py
+    s += f'{runner_command}\n'
+    s += 'date\n'
+    return s
+
+
 POPULATION_SIZE = 100
 MUTATION_PROBABILITY = 0.3
 N_TO_TEST = 20
-SLURM_SLEEP_INTERVAL = 1
-SLURM_JOB_PREFIX = "GA_" + os.path.basename(os.getcwd())
-MAX_N_JOBS_RELAX = 3
+SLURM_POLL_INTERVAL = 60  # seconds; finished jobs wake the driver earlier through their _done.traj
+SLURM_QSTAT_TTL = 5  # seconds between squeue calls
+SLURM_JOB_PREFIX = "GA_"  # + name of the Mg-$i directory
+MAX_N_JOBS_RELAX = 3  # counts candidates, not allocations, when PACK_SIZE > 1
 MAX_N_JOBS_GA = 2
+PACK_SIZE = 1  # candidates relaxed side by side in one allocation; 1 = one job per candidate
+PRERELAX = False  # pre-relax offspring with PRERELAX_CALCULATOR before VASP, discarding broken ones
+PRERELAX_CALCULATOR = None  # ASE calculator for PRERELAX covering every element here, e.g. an ML potential (or EMT())
+PRERELAX_FMAX = 0.1  # eV/A
+PRERELAX_STEPS = 200
+SURROGATE = False  # submit only the most promising of SURROGATE_POOL_SIZE offspring, by a model fitted to gadb.db
+SURROGATE_POOL_SIZE = 10  # offspring generated per free slot
+SURROGATE_KAPPA = 0.0  # 0: lowest predicted energy; > 0 also favors offspring the model is unsure about
+SURROGATE_MIN_TRAIN = 10  # relaxed candidates needed before the model is used
+DEDUPLICATE = False  # skip offspring that are duplicates (same criteria as comp) of relaxed or queued candidates
+OFFSPRING_BUFFER_SIZE = 4  # new candidates made ahead of time in the background
+OFFSPRING_MAX_FAILURES = 200  # offspring rejected in a row (pairing, PRERELAX, DEDUPLICATE) after which the GA stops
+HULL_SCORE = False  # raw_score = -(energy above the convex hull of all Mg-$i) instead of -energy (see convex_hull.py)
+
+# Reference energies of the convex hull (as in extract_ga_energy): ref_full * i/N_FULL + ref_empty * (N_FULL-i)/N_FULL
+REF_EMPTY = -1869.25113670
+REF_FULL = -1952.30429536
+N_FULL = 12  # number of ions when structure is "full"
 
 INITIAL_DB_SIZE = 20
+tmp_folder = 'tmp_ga/'  # inside the Mg-$i directory, which jobs are submitted from
+
+
+def write_population_scores(population, tmp_folder):
+    """-Energies of the current population, read by calc.py to stop relaxations that cannot enter it"""
+    population.update()
+    scores = [-c.get_potential_energy() for c in population.pop]  # not raw_score, which may be the hull distance
+    with open(os.path.join(tmp_folder, 'population.json.tmp'), 'w') as f:
+        json.dump({'size': POPULATION_SIZE, 'raw_scores': scores}, f)
+    os.replace(os.path.join(tmp_folder, 'population.json.tmp'), os.path.join(tmp_folder, 'population.json'))
+
+
+class CompositionGA:
+    """
+    The GA of one Mg-$i directory: its database, SLURM jobs, population and
+    offspring. Run on its own by the __main__ block below (from inside Mg-$i),
+    or together with the other compositions by main_run_all.py.
+
+    Args:
+        run_dir (str): the Mg-$i directory (with gadb.db and calc.py)
+        queue (SlurmQueue, optional): squeue snapshot shared with other compositions
+        log_prefix (str): printed in front of every message (e.g. 'Mg-3: ')
+        hull_feed (HullFeed, optional): convex hull of all compositions, kept up
+            to date by the caller. With HULL_SCORE and no hull_feed, one over
+            this and the sibling Mg-$j directories is made and updated here.
+    """
+    def __init__(self, run_dir='.', queue=None, log_prefix='', hull_feed=None):
+        self.run_dir = run_dir
+        self.name = os.path.basename(os.path.abspath(run_dir))
+        self.log_prefix = log_prefix
+        self.db_path = os.path.join(run_dir, 'gadb.db')
+        self.tmp_folder = os.path.join(run_dir, tmp_folder)
+        self.da = DataConnection(self.db_path)
+        self.slurm_run = SLURMQueueRun(self.da,
+                                       tmp_folder=self.tmp_folder,
+                                       job_prefix=SLURM_JOB_PREFIX + self.name,
+                                       n_relax=MAX_N_JOBS_RELAX,
+                                       n_ga=MAX_N_JOBS_GA,
+                                       job_template_generator=jtg,
+                                       qstat_ttl=SLURM_QSTAT_TTL,
+                                       pack_size=PACK_SIZE,
+                                       pack_template_generator=pack_jtg,
+                                       queue=queue,
+                                       submit_dir=run_dir,
+                                       )
+
+        self.hull_feed = None
+        self.own_hull_feed = False
+        if HULL_SCORE:
+            self.hull_feed = hull_feed
+            if self.hull_feed is None:
+                self.hull_feed = HullFeed(ConvexHull(REF_EMPTY, REF_FULL, N_FULL), sibling_databases(run_dir))
+                self.own_hull_feed = True
+            self.slurm_run.raw_score_function = self.hull_score
+
+        atom_numbers_to_optimize = self.da.get_atom_numbers_to_optimize()
+        self.n_to_optimize = len(atom_numbers_to_optimize)
+        skeleton = self.da.get_slab()
+        self.all_atom_types = get_all_atom_types(skeleton, atom_numbers_to_optimize)
+        self.blmin = closest_distances_generator(self.all_atom_types,
+                                                 ratio_of_covalent_radii=0.7)
+
+        self.comp = InteratomicDistanceComparator(n_top=self.n_to_optimize,
+                                                  pair_cor_cum_diff=0.015,
+                                                  pair_cor_max=0.7,
+                                                  dE=0.02,
+                                                  mic=False)
+
+        self.pairing = CutAndSplicePairing(skeleton, self.n_to_optimize, self.blmin,
+                                           number_of_variable_cell_vectors=3)
+        self.mutations = OperationSelector([1., 1.],
+                                           [MirrorMutation(self.blmin, self.n_to_optimize),
+                                            RattleMutation(self.blmin, self.n_to_optimize),
+                                           ])  # PermutationMutation is useless when all intercalating ions are the same
+
+        self.population = None
+        self.offspring = None
+        self.relaxed = []  # relaxed candidates (population.all_cand), as of the last refresh_population()
+
+    def hull_score(self, a):
+        """raw_score of a relaxed structure with HULL_SCORE: -(energy above the hull)"""
+        if self.own_hull_feed:
+            self.hull_feed.update()
+        hull = self.hull_feed.hull
+        hull.add([self.n_to_optimize], [a.get_potential_energy()])
+        return -float(hull.e_above_hull([self.n_to_optimize], [a.get_potential_energy()])[0])
+
+    def rescore(self):
+        """
+        Recomputes the raw_score of all relaxed candidates with the current
+        hull (HULL_SCORE), in memory and in the database, so they stay
+        comparable with new candidates when the hull has moved.
+        """
+        candidates = self.population.all_cand
+        if not candidates:
+            return
+        energies = np.array([c.get_potential_energy() for c in candidates])
+        scores = -self.hull_feed.hull.e_above_hull(np.full(len(candidates), self.n_to_optimize), energies)
+        old_scores = np.array([get_raw_score(c) for c in candidates])
+        changed = np.flatnonzero(np.abs(scores - old_scores) > 1e-6)
+        if len(changed) == 0:
+            return
+        with self.da.c:
+            for k in changed:
+                candidates[k].info['key_value_pairs']['raw_score'] = float(scores[k])
+                self.da.c.update(candidates[k].info['relax_id'], raw_score=float(scores[k]))
+        self.population.pop.sort(key=get_raw_score, reverse=True)
+        self.log(f"Rescored {len(changed)} candidates with the current convex hull")
+
+    def log(self, message):
+        print(f'{self.log_prefix}{message}', flush=True)
+
+    def reset_queue(self):
+        """Resets terminated structures so that calc.py can resume them"""
+        for qid in self.da.get_all_candidates_in_queue():
+            if not self.slurm_run.is_running(qid):
+                self.da.remove_from_queue(qid)
 
-print(f"Hostname: {socket.gethostname()}", flush=True)
-print(f"Process ID: {os.getpid()}", flush=True)
-
-# Initialize the different components of the GA
-da = DataConnection('gadb.db')
-tmp_folder = 'tmp_ga/'
-slurm_run = SLURMQueueRun(da,
-                          tmp_folder=tmp_folder,
-                          job_prefix=SLURM_JOB_PREFIX,
-                          n_relax=MAX_N_JOBS_RELAX,
-                          n_ga=MAX_N_JOBS_GA,
-                          job_template_generator=jtg,
-                          )
-
-atom_numbers_to_optimize = da.get_atom_numbers_to_optimize()
-n_to_optimize = len(atom_numbers_to_optimize)
-skeleton = da.get_slab()
-all_atom_types = get_all_atom_types(skeleton, atom_numbers_to_optimize)
-blmin = closest_distances_generator(all_atom_types,
-                                    ratio_of_covalent_radii=0.7)
-
-comp = InteratomicDistanceComparator(n_top=n_to_optimize,
-                                     pair_cor_cum_diff=0.015,
-                                     pair_cor_max=0.7,
-                                     dE=0.02,
-                                     mic=False)
-
-pairing = CutAndSplicePairing(skeleton, n_to_optimize, blmin, number_of_variable_cell_vectors=3)
-mutations = OperationSelector([1., 1.],
-                              [MirrorMutation(blmin, n_to_optimize),
-                               RattleMutation(blmin, n_to_optimize),
-                              ])  # PermutationMutation is useless when all intercalating ions are the same
-
-# Relax all unrelaxed structures (e.g. the starting population)
-slurm_run.__cleanup__()
-print("# unrelaxed:", da.get_number_of_unrelaxed_candidates())
-print("# relaxed:", len(da.get_all_relaxed_candidates()))
-print("# previously queued:", len(da.get_all_candidates_in_queue()))
-sys.stdout.flush()
-while True:  # outer loop for case where SLURM job gets terminated while this script is running
-    # the only way to exit this loop is if there are no new candidates to submit AND no jobs are running
-    for qid in da.get_all_candidates_in_queue():  # reset terminated structures so that calc.py can resume them
-        if not slurm_run.is_running(qid):
-            da.remove_from_queue(qid)
-
-    need_to_run_more = False
-    while da.get_number_of_unrelaxed_candidates() > 0:
-        need_to_run_more = True
-        print(f'{da.get_number_of_unrelaxed_candidates()} more to relax', flush=True)
-        print(f'{slurm_run.number_of_jobs_running()} jobs running', flush=True)
-        while (da.get_number_of_unrelaxed_candidates() > 0) and (not slurm_run.enough_jobs_running_relax()):
-            a = da.get_an_unrelaxed_candidate()
-            slurm_exit_code = slurm_run.relax(a)
+    def submit_unrelaxed(self):
+        """Fills the free relaxation slots. Returns whether unrelaxed candidates are left."""
+        self.log(f'{self.da.get_number_of_unrelaxed_candidates()} more to relax')
+        while (self.da.get_number_of_unrelaxed_candidates() > 0) and (not self.slurm_run.enough_jobs_running_relax()):
+            a = self.da.get_an_unrelaxed_candidate()
+            slurm_exit_code = self.slurm_run.relax(a)
             if slurm_exit_code:
                 raise ValueError("Failed to submit relaxation job\n"
                                  "I refuse to continue\n"
                                  "Cancel all jobs, resolve issue, and try again\n"
                                  )
-        time.sleep(SLURM_SLEEP_INTERVAL)
-
-    while slurm_run.number_of_jobs_running() > 0:
-        need_to_run_more = True
-        print(f'Waiting for {slurm_run.number_of_jobs_running()} jobs to finish', flush=True)
-        time.sleep(SLURM_SLEEP_INTERVAL)
-
-    if not need_to_run_more:
-        break
-slurm_run.__cleanup__()
-
-if n_to_optimize < 2:
-    # Can't do cut and splice pairing with fewer than 2 atoms
-    print("Exiting before starting GA because n_to_optimize < 2.")
-else:
-    # create the population
-    population_created = False
-    while not population_created:
-        try:
-            population = Population(data_connection=da,
-                                    population_size=POPULATION_SIZE,
-                                    comparator=comp)
-            population_created = True
-        except KeyError:  # KeyError: 'parents'
-
-            db = connect("gadb.db")
-
-            # get gaid of orphans
-            orphan_gaids = []
-            for row in db.select():
-                if 'pairing' in row.key_value_pairs:
-                    if row.key_value_pairs['pairing'] == 1:
-                        if 'parents' not in row.data:
-                            orphan_gaids.append(row.key_value_pairs['gaid'])
-
-
-            # get row ids of orphans
-            orphan_row_ids = {gaid:[] for gaid in orphan_gaids}
-            for row in db.select():
-                for gaid in orphan_gaids:
-                    if 'gaid' in row.key_value_pairs and row.key_value_pairs['gaid'] == gaid:
-                        orphan_row_ids[gaid].append(row.id)
-
-            print("Orphan {gaid:[ids]}:")
-            print(orphan_row_ids)
-
-            print("Deleting rows...")
-            orphan_row_ids = list(chain.from_iterable(orphan_row_ids.values()))
-            print(orphan_row_ids)
-            db.delete(ids=orphan_row_ids)
-            print("Done")
-
-    # Submit new candidates until enough are running
-    n_tested = len(da.get_all_relaxed_candidates()) - INITIAL_DB_SIZE
-    while n_tested < N_TO_TEST:
-        while (not slurm_run.enough_jobs_running_ga() and
-            len(population.get_current_population()) >= 2 and
-            n_tested < N_TO_TEST):
-            print("Generating new candidate...", flush=True)
-            a1, a2 = population.get_two_candidates()
-            a3, desc = pairing.get_new_individual([a1, a2])
-            print(a3)
-            print(desc)
-            if a3 is None:
-                print("Unable to generate new candidate", flush=True)
-                continue
-            da.add_unrelaxed_candidate(a3, description=desc)
-            print("Generated new candidate", flush=True)
-
-            if random() < MUTATION_PROBABILITY:
-                a3_mut, desc = mutations.get_new_individual([a3])
-                if a3_mut is not None:
-                    da.add_unrelaxed_step(a3_mut, desc)
-                    a3 = a3_mut
-            slurm_exit_code = slurm_run.relax(a3)
+        return self.da.get_number_of_unrelaxed_candidates() > 0
+
+    def create_population(self):
+        """Creates the population, deleting offspring without parent information if needed"""
+        while True:
+            try:
+                return Population(data_connection=self.da,
+                                  population_size=POPULATION_SIZE,
+                                  comparator=self.comp,
+                                  use_extinct=True)  # without the failed candidates (see calc.py)
+            except KeyError:  # KeyError: 'parents'
+
+                db = connect(self.db_path)
+
+                # get gaid of orphans
+                orphan_gaids = []
+                for row in db.select():
+                    if 'pairing' in row.key_value_pairs:
+                        if row.key_value_pairs['pairing'] == 1:
+                            if 'parents' not in row.data:
+                                orphan_gaids.append(row.key_value_pairs['gaid'])
+
+
+                # get row ids of orphans
+                orphan_row_ids = {gaid:[] for gaid in orphan_gaids}
+                for row in db.select():
+                    for gaid in orphan_gaids:
+                        if 'gaid' in row.key_value_pairs and row.key_value_pairs['gaid'] == gaid:
+                            orphan_row_ids[gaid].append(row.id)
+
+                self.log("Orphan {gaid:[ids]}:")
+                self.log(orphan_row_ids)
+
+                self.log("Deleting rows...")
+                orphan_row_ids = list(chain.from_iterable(orphan_row_ids.values()))
+                self.log(orphan_row_ids)
+                db.delete(ids=orphan_row_ids)
+                self.log("Done")
+
+    def start_ga(self):
+        """Creates the population and starts making offspring (needs n_to_optimize >= 2)"""
+        self.population = self.create_population()
+        self.population_lock = threading.Lock()  # population and surrogate are shared with the offspring producer
+        if self.hull_feed is not None:
+            if self.own_hull_feed:
+                self.hull_feed.update()
+            self.rescore()
+        write_population_scores(self.population, self.tmp_folder)
+
+        self.n_tested = self.da.c.count(relaxed=1) - INITIAL_DB_SIZE
+        self.n_prerelax_rejected = 0
+        self.prerelax_calc = None
+        if PRERELAX:
+            if PRERELAX_CALCULATOR is None:
+                raise ValueError("PRERELAX = True needs a calculator: set PRERELAX_CALCULATOR in main_run.py")
+            self.prerelax_calc = PRERELAX_CALCULATOR
+            if self.population.pop:
+                check_calculator(self.prerelax_calc, self.population.pop[0])  # fail now rather than reject every offspring
+        self.n_duplicates = 0
+        self.n_duplicates_in_row = 0
+        self.fingerprints = FingerprintIndex(os.path.join(self.run_dir, 'gadb_fingerprints.db'), self.n_to_optimize,
+                                             cum_diff=self.comp.pair_cor_cum_diff,
+                                             max_diff=self.comp.pair_cor_max,
+                                             mic=self.comp.mic) if DEDUPLICATE else None
+
+        self.surrogate = KernelRidgeSurrogate(PairDistanceFingerprint(self.all_atom_types)) if SURROGATE else None
+
+        self.starved = False  # set when the offspring producer gives up (OFFSPRING_MAX_FAILURES)
+        self.offspring = OffspringBuffer(self.produce_offspring, size=OFFSPRING_BUFFER_SIZE,
+                                         max_failures=OFFSPRING_MAX_FAILURES)
+        self.offspring.start()
+
+    def new_offspring(self):
+        """
+        Pairs two members of the population. With SURROGATE, the best of
+        SURROGATE_POOL_SIZE such offspring by predicted energy - SURROGATE_KAPPA * uncertainty.
+        """
+        if not SURROGATE:
+            with self.population_lock:
+                a1, a2 = self.population.get_two_candidates()
+            return self.pairing.get_new_individual([a1, a2])
+        pool = []
+        for _ in range(SURROGATE_POOL_SIZE):
+            with self.population_lock:
+                a1, a2 = self.population.get_two_candidates()
+            a3, desc = self.pairing.get_new_individual([a1, a2])
+            if a3 is not None:
+                pool.append((a3, desc))
+        if not pool:
+            return None, None
+        with self.population_lock:
+            if self.surrogate.n_train < SURROGATE_MIN_TRAIN:
+                return pool[0]
+            mean, std = self.surrogate.predict([a3 for a3, desc in pool])
+        best = np.argmin(mean - SURROGATE_KAPPA * std)
+        self.log(f"Surrogate picked offspring {best + 1} of {len(pool)}: "
+                 f"predicted energy {mean[best]:.3f} +- {std[best]:.3f} eV "
+                 f"(pool: {mean.min():.3f} to {mean.max():.3f} eV, {self.surrogate.n_train} training candidates)")
+        return pool[best]
+
+    def produce_offspring(self):
+        """
+        Runs in the offspring producer (see offspring_buffer.py). Returns a
+        candidate that passed pairing, mutation and pre-relaxation, before
+        anything is written to the database:
+            {'child': (atoms, desc), 'mutation': (atoms, desc) or None,
+             'prerelax': (atoms, desc) or None, 'final': atoms to relax}
+        or None if it was rejected.
+        """
+        with self.population_lock:
+            n_population = len(self.population.get_current_population())
+        if n_population < 2:
+            time.sleep(1)
+            return None
+        a3, desc = self.new_offspring()
+        if a3 is None:
+            self.log("Unable to generate new candidate")
+            return None
+        a3.info['confid'] = None  # given by the database when the candidate is submitted
+        item = {'child': (a3, desc), 'mutation': None, 'prerelax': None, 'final': a3}
+
+        if random() < MUTATION_PROBABILITY:
+            a3_mut, desc = self.mutations.get_new_individual([a3])
+            if a3_mut is not None:
+                item['mutation'] = (a3_mut, desc)
+                item['final'] = a3_mut
+        if PRERELAX:
+            calc = self.prerelax_calc
+            a3_pre, reason = prerelax(item['final'], calc, self.blmin, fmax=PRERELAX_FMAX, steps=PRERELAX_STEPS)
+            if a3_pre is None:
+                self.log(f"Discarding new candidate after pre-relaxation: {reason}")
+                self.n_prerelax_rejected += 1
+                return None
+            item['prerelax'] = (a3_pre, f'prerelax: {calc.name}')
+            item['final'] = a3_pre
+        return item
+
+    def refresh_population(self):
+        """Picks up the candidates relaxed since the last poll cycle"""
+        if self.own_hull_feed:
+            self.hull_feed.update()
+        with self.population_lock:
+            self.population.update()
+            if self.hull_feed is not None:
+                self.rescore()
+            write_population_scores(self.population, self.tmp_folder)
+            # from the population, never from da.get_all_relaxed_candidates(): that also marks the
+            # candidates as returned, so population.update() (only_new=True) would never see them
+            all_cand = list(self.population.all_cand)
+            self.relaxed = all_cand
+            if SURROGATE:
+                # pruned candidates only have the energy at which their relaxation was stopped
+                self.surrogate.update([c for c in all_cand if not c.info['key_value_pairs'].get('pruned')])
+        if DEDUPLICATE:
+            self.fingerprints.update(all_cand)
+
+    def submit_offspring(self, refresh=True):
+        """
+        Fills the free GA slots with offspring from the buffer. Returns whether
+        more should be tested. refresh=False if refresh_population() was
+        already called this cycle.
+        """
+        if refresh:
+            self.refresh_population()
+        while (not self.slurm_run.enough_jobs_running_ga() and
+            len(self.population.get_current_population()) >= 2 and
+            self.n_tested < N_TO_TEST and not self.starved):
+            try:
+                item = self.offspring.pop()
+            except ProducerStarved as e:
+                self.log(f"Stopping the GA, no new candidates can be made: {e} "
+                         f"({self.n_prerelax_rejected} discarded by the pre-relaxation so far)")
+                self.starved = True
+                break
+            a3, desc = item['child']
+            final = item['final']
+            self.log(a3)
+            self.log(desc)
+            if DEDUPLICATE:
+                duplicate_of = self.fingerprints.find_duplicate(final)
+                if duplicate_of is not None:
+                    self.log(f"Skipping new candidate: duplicate of candidate {duplicate_of}")
+                    self.n_duplicates += 1
+                    self.n_duplicates_in_row += 1
+                    if self.n_duplicates_in_row >= OFFSPRING_MAX_FAILURES:
+                        self.log(f"Stopping the GA, no new candidates can be made: "
+                                 f"{self.n_duplicates_in_row} duplicates in a row")
+                        self.starved = True
+                        break
+                    continue
+                self.n_duplicates_in_row = 0
+            self.da.add_unrelaxed_candidate(a3, description=desc)
+            self.log("Generated new candidate")
+            if item['mutation'] is not None:
+                a3_mut, desc = item['mutation']
+                a3_mut.info['confid'] = a3.info['confid']
+                a3_mut.info['data']['parents'] = [a3.info['confid']]
+                self.da.add_unrelaxed_step(a3_mut, desc)
+            if item['prerelax'] is not None:
+                a3_pre, desc = item['prerelax']
+                a3_pre.info['confid'] = a3.info['confid']
+                self.da.add_unrelaxed_step(a3_pre, desc)
+            if DEDUPLICATE:
+                self.fingerprints.add(final, relaxed=False)
+            slurm_exit_code = self.slurm_run.relax(final)
             if slurm_exit_code:
                 raise ValueError("Failed to submit relaxation job\n"
                                  "I refuse to continue\n"
                                  "Cancel all jobs, resolve issue, and try again\n"
                                  )
+            self.n_tested += 1
+        self.log(f'{self.n_tested} candidates tested')
+        self.log(f'{self.offspring.items.qsize()} new candidates ready')
+        if PRERELAX:
+            self.log(f'{self.n_prerelax_rejected} candidates discarded by the pre-relaxation')
+        if DEDUPLICATE:
+            self.log(f'{self.n_duplicates} duplicate candidates skipped')
+        self.log(f'Current population: {len(self.population.get_current_population())}')
+        return self.n_tested < N_TO_TEST and not self.starved
+
+    def finish(self):
+        """Stops making offspring and writes all relaxed candidates to all_candidates.traj"""
+        if self.offspring is not None:
+            self.offspring.stop()
+            self.offspring = None
+        write(os.path.join(self.run_dir, 'all_candidates.traj'), self.da.get_all_relaxed_candidates())
+
+
+if __name__ == '__main__':
+    print(f"Hostname: {socket.gethostname()}", flush=True)
+    print(f"Process ID: {os.getpid()}", flush=True)
+
+    # Initialize the different components of the GA
+    ga = CompositionGA()
+    da = ga.da
+    slurm_run = ga.slurm_run
+
+    # Relax all unrelaxed structures (e.g. the starting population)
+    slurm_run.__cleanup__()
+    print("# unrelaxed:", da.get_number_of_unrelaxed_candidates())
+    print("# relaxed:", da.c.count(relaxed=1))
+    print("# previously queued:", len(da.get_all_candidates_in_queue()))
+    sys.stdout.flush()
+
+    while True:  # outer loop for case where SLURM job gets terminated while this script is running
+        # the only way to exit this loop is if there are no new candidates to submit AND no jobs are running
+        ga.reset_queue()
+
+        need_to_run_more = asyncio.run(slurm_run.drive(ga.submit_unrelaxed, poll_interval=SLURM_POLL_INTERVAL))
 
-            population.update()
-            n_tested += 1
-        print(f'{n_tested} candidates tested')
-        print(f'{slurm_run.number_of_jobs_running()} jobs running')
-        print(f'Current population: {len(population.get_current_population())}')
-        sys.stdout.flush()
-        time.sleep(SLURM_SLEEP_INTERVAL)
+        if not need_to_run_more:
+            break
+    slurm_run.__cleanup__()
 
-    # Wait for all jobs to finish
-    while slurm_run.number_of_jobs_running() > 0:
-        print(f'Waiting for {slurm_run.number_of_jobs_running()} jobs to finish', flush=True)
-        time.sleep(SLURM_SLEEP_INTERVAL)
+    if ga.n_to_optimize < 2:
+        # Can't do cut and splice pairing with fewer than 2 atoms
+        print("Exiting before starting GA because n_to_optimize < 2.")
+    else:
+        # Submit new candidates until enough are running
+        ga.start_ga()
+        # Returns once N_TO_TEST candidates are submitted and all jobs have finished
+        asyncio.run(slurm_run.drive(ga.submit_offspring, poll_interval=SLURM_POLL_INTERVAL))
 
-write('all_candidates.traj', da.get_all_relaxed_candidates())
+    ga.finish()
@@ -0,0 +1,159 @@
+"""
+Runs the GA of several compositions (Mg-$i directories) from one process.
+
+Instead of one main_run.py per Mg-$i, each with its own MAX_N_JOBS_RELAX /
+MAX_N_JOBS_GA and its own squeue polling, all compositions share a budget of
+MAX_N_JOBS relaxations and a single squeue call per cycle. All other GA
+settings (population, operators, N_TO_TEST, job scripts, ...) are the ones
+in main_run.py.
+
+Every cycle, the free slots are handed out one at a time to the composition
+with the fewest jobs (running + already assigned) relative to its weight:
+    - still relaxing its starting population: 1
+    - running the GA: 1 - n_stale / STALL_WINDOW, where n_stale is the number
+      of candidates relaxed since the lowest energy (the running minimum
+      plotted by monitor_ga.py) came within IMPROVEMENT_TOL of its current value
+With HULL_FOCUS, the weight of a GA composition is also multiplied by
+exp(-d / HULL_FOCUS), d being the energy above the convex hull of all
+compositions (convex_hull.py) of its lowest candidate, so that slots go to
+compositions that are on or near the hull.
+A composition with weight 0 (converged) or N_TO_TEST tested candidates gets
+no new slots, and is finished (all_candidates.traj) once its jobs are done.
+A converged composition whose running jobs find a better structure gets
+slots again.
+
+Run from the Mg directory: nohup python main_run_all.py Mg 1 12 &
+"""
+import argparse
+import asyncio
+import os
+import socket
+
+import numpy as np
+
+from convex_hull import ConvexHull, HullFeed
+from main_run import (CompositionGA, HULL_SCORE, N_FULL, N_TO_TEST, REF_EMPTY, REF_FULL,
+                      SLURM_POLL_INTERVAL, SLURM_QSTAT_TTL)
+from monitor_ga import candidate_energies, running_minimum
+from slurmqueuerun import SlurmQueue, drive_runs
+
+MAX_N_JOBS = 12  # relaxations running at once over all compositions (candidates, not allocations, when PACK_SIZE > 1)
+STALL_WINDOW = 30  # relaxed candidates without improvement after which a composition gets no new slots
+IMPROVEMENT_TOL = 0.01  # eV; smaller drops of the lowest energy do not count as improvement
+HULL_FOCUS = None  # eV; e.g. 0.05 to favor compositions whose lowest candidate is near the convex hull
+
+
+def n_stale(candidates, tol=IMPROVEMENT_TOL):
+    """Number of candidates relaxed (by confid) since the lowest energy came within tol of its current value."""
+    best = running_minimum([energy for confid, energy in candidate_energies(candidates)])
+    if len(best) == 0:
+        return 0
+    return len(best) - 1 - int(np.argmax(best <= best[-1] + tol))
+
+
+def allocate(weights, n_running, n_free):
+    """Hands out n_free slots one at a time to the composition with the lowest (jobs + 1) / weight. Returns the new slots of each."""
+    new = [0] * len(weights)
+    for _ in range(n_free):
+        options = [i for i, w in enumerate(weights) if w > 0]
+        if not options:
+            break
+        i = min(options, key=lambda i: (n_running[i] + new[i] + 1) / weights[i])
+        new[i] += 1
+    return new
+
+
+def main(ion_type, lower_bound, upper_bound):
+    print(f"Hostname: {socket.gethostname()}", flush=True)
+    print(f"Process ID: {os.getpid()}", flush=True)
+
+    queue = SlurmQueue(ttl=SLURM_QSTAT_TTL)
+    run_dirs = {}  # ion count -> Mg-$i
+    for i in range(lower_bound, upper_bound + 1):
+        run_dir = os.path.abspath(f'{ion_type}-{i}')
+        if not os.path.isfile(os.path.join(run_dir, 'gadb.db')):
+            print(f"[Warning] Database not found: {run_dir}/gadb.db. Skipping.", flush=True)
+            continue
+        run_dirs[i] = run_dir
+    # one convex hull of all compositions, updated once per cycle
+    hull_feed = None
+    if HULL_SCORE or HULL_FOCUS:
+        hull_feed = HullFeed(ConvexHull(REF_EMPTY, REF_FULL, N_FULL),
+                             {i: os.path.join(run_dir, 'gadb.db') for i, run_dir in run_dirs.items()})
+        hull_feed.update()
+    counts = list(run_dirs)
+    runs = [CompositionGA(run_dir, queue=queue, log_prefix=f'{ion_type}-{i}: ', hull_feed=hull_feed)
+            for i, run_dir in run_dirs.items()]
+    phases = ['relax'] * len(runs)  # -> 'ga' -> 'done'
+    printed_hull = [None]
+
+    for ga in runs:
+        ga.slurm_run.__cleanup__()
+        ga.reset_queue()
+        ga.log(f"# unrelaxed: {ga.da.get_number_of_unrelaxed_candidates()}, "
+               f"# relaxed: {ga.da.c.count(relaxed=1)}")
+
+    def submit_all():
+        """Moves compositions to their next phase and shares the free slots among them. Returns whether any is not done."""
+        n_running = [ga.slurm_run.number_of_jobs_running() for ga in runs]
+        weights = [0.] * len(runs)
+        if hull_feed is not None:
+            hull_feed.update()
+            vertices = [(int(n), round(e_f, 4)) for n, e_f in hull_feed.hull.vertices]
+            if vertices != printed_hull[0]:  # also moved by the candidates scored when ingested
+                print(f"Convex hull (ion count, formation energy): {vertices}", flush=True)
+                printed_hull[0] = vertices
+        for k, ga in enumerate(runs):
+            if phases[k] == 'relax' and ga.da.get_number_of_unrelaxed_candidates() == 0 and n_running[k] == 0:
+                ga.reset_queue()  # candidates whose job died are relaxed again
+                if ga.da.get_number_of_unrelaxed_candidates() == 0:
+                    ga.slurm_run.__cleanup__()
+                    if ga.n_to_optimize < 2:
+                        # Can't do cut and splice pairing with fewer than 2 atoms
+                        ga.log("Not starting GA because n_to_optimize < 2.")
+                        ga.finish()
+                        phases[k] = 'done'
+                    else:
+                        ga.start_ga()
+                        phases[k] = 'ga'
+            if phases[k] == 'relax':
+                weights[k] = 1. if ga.da.get_number_of_unrelaxed_candidates() > 0 else 0.
+            elif phases[k] == 'ga':
+                ga.refresh_population()
+                stale = n_stale(ga.relaxed)
+                weights[k] = max(1. - stale / STALL_WINDOW, 0.) if ga.n_tested < N_TO_TEST and not ga.starved else 0.
+                if HULL_FOCUS and hull_feed.hull.best_e_above_hull(counts[k]) is not None:
+                    weights[k] *= np.exp(-hull_feed.hull.best_e_above_hull(counts[k]) / HULL_FOCUS)
+                if weights[k] == 0 and n_running[k] == 0:
+                    ga.log(f"Finished: {ga.n_tested} candidates tested, {stale} since the last improvement")
+                    ga.finish()
+                    phases[k] = 'done'
+
+        new = allocate(weights, n_running, MAX_N_JOBS - sum(n_running))
+        for k, ga in enumerate(runs):
+            if phases[k] != 'done':
+                ga.log(f"{phases[k]}, {n_running[k]} running, weight {weights[k]:.3g}, {new[k]} new slots")
+            if new[k] == 0:
+                continue
+            if phases[k] == 'relax':
+                ga.slurm_run.n_relax = n_running[k] + new[k]
+                ga.submit_unrelaxed()
+            else:
+                ga.slurm_run.n_simul = n_running[k] + new[k]
+                ga.submit_offspring(refresh=False)
+        return any(phase != 'done' for phase in phases)
+
+    # Returns once every composition is done and all jobs have finished
+    asyncio.run(drive_runs([ga.slurm_run for ga in runs], submit_all, poll_interval=SLURM_POLL_INTERVAL))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Run the GA of several compositions with a shared job budget."
+    )
+    parser.add_argument('ion_type', type=str, help='The chemical symbol of the intercalated ion (e.g., Li, Na, Mg).')
+    parser.add_argument('lower_bound', type=int, help='The starting number of ions (inclusive).')
+    parser.add_argument('upper_bound', type=int, help='The ending number of ions (inclusive).')
+    args = parser.parse_args()
+
+    main(args.ion_type, args.lower_bound, args.upper_bound)
@@ -1,10 +1,155 @@
 import os
 import argparse
+import csv
+import sqlite3
+import time
 from ase.io import read
 from ase.ga.data import DataConnection
-import matplotlib.pyplot as plt
 import numpy as np
 
+
+def candidate_energies(candidates):
+    """
+    Returns [(confid, energy)] of relaxed GA candidates, sorted by confid
+    (the order in which they were created). Candidates with a missing
+    'confid' or energy are skipped with a warning, and pruned candidates
+    (calc.py with PRUNE) are left out, as in the --follow mode.
+    """
+    candidate_data = []
+    for cand in candidates:
+        if cand.info.get('key_value_pairs', {}).get('pruned'):
+            continue
+        try:
+            confid = cand.info['confid']
+            energy = cand.get_potential_energy()
+            candidate_data.append((confid, energy))
+        except (KeyError, AttributeError, RuntimeError):
+            print(f"  [Warning] Skipping a candidate with missing 'confid' or energy.")
+    candidate_data.sort(key=lambda x: x[0])
+    return candidate_data
+
+
+def running_minimum(energies):
+    """Returns the lowest energy found after each candidate."""
+    return np.minimum.accumulate(energies) if len(energies) else np.zeros(0)
+
+
+# relaxed candidates added after a given row, in the order they were written, except pruned
+# ones (calc.py with PRUNE), whose energy is where their relaxation was stopped
+NEW_RELAXED_ROWS = """
+    SELECT systems.id, systems.energy FROM systems
+    JOIN number_key_values ON number_key_values.id = systems.id
+    WHERE number_key_values.key = 'relaxed' AND number_key_values.value = 1 AND systems.id > ?
+    AND NOT EXISTS (SELECT 1 FROM number_key_values AS pruned
+                    WHERE pruned.id = systems.id AND pruned.key = 'pruned' AND pruned.value != 0)
+    ORDER BY systems.id
+"""
+
+
+class RunTrace:
+    """
+    Running minimum of the energy of one GA run, kept up to date by reading
+    only the rows added to its database since the last update.
+
+    Candidates are counted in the order they finished relaxing (row id), not
+    by confid, so that new candidates only ever extend the trace.
+    """
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.last_id = 0  # highest row id read so far
+        self.best = []  # lowest energy after each candidate
+
+    def update(self):
+        """Reads the candidates relaxed since the last call. Returns how many there were, or None if the trace was reset."""
+        con = sqlite3.connect(f'file:{self.db_path}?mode=ro', uri=True)
+        try:
+            reset = (self.last_id > 0 and
+                     con.execute('SELECT 1 FROM systems WHERE id = ?', (self.last_id,)).fetchone() is None)
+            if reset:  # rows were deleted (e.g. clean_kids_from_db.py) or the database was recreated
+                self.last_id = 0
+                self.best = []
+            rows = con.execute(NEW_RELAXED_ROWS, (self.last_id,)).fetchall()
+        finally:
+            con.close()
+        for row_id, energy in rows:
+            if energy is not None:
+                self.best.append(min(energy, self.best[-1]) if self.best else energy)
+        if rows:
+            self.last_id = rows[-1][0]
+        return None if reset else len(rows)
+
+
+def follow_ga_runs(ion_type, lower_bound, upper_bound, save_path=None, interval=60., series_path=None):
+    """
+    Like monitor_ga_runs(), but keeps running and refreshes the plot every
+    interval seconds. Each refresh only reads the candidates relaxed since the
+    previous one (see RunTrace) and updates the lines in place.
+
+    Args:
+        save_path (str, optional): Path the plot is saved to after every
+                                   refresh. If None, it is shown in a window.
+        series_path (str, optional): CSV file to which the number of
+                                     candidates and lowest energy of every run
+                                     are appended when they change.
+    """
+    import matplotlib.pyplot as plt
+
+    plt.style.use('seaborn-v0_8-whitegrid')
+    fig, ax = plt.subplots(figsize=(12, 8))
+    ax.set_title(f'GA Convergence for {ion_type} Intercalation', fontsize=16)
+    ax.set_xlabel('Number of Candidates Evaluated', fontsize=12)
+    ax.set_ylabel('Lowest Relative Energy Found (eV)', fontsize=12)
+    if save_path is None:
+        plt.ion()
+        plt.show()
+
+    traces = {i: RunTrace(os.path.join(f"{ion_type}-{i}", 'gadb.db')) for i in range(lower_bound, upper_bound + 1)}
+    lines = {}
+    print(f"--- Following GA runs every {interval:g} s (Ctrl-C to stop) ---")
+    try:
+        while True:
+            changed = False
+            for i, trace in traces.items():
+                if not os.path.isfile(trace.db_path):
+                    continue
+                try:
+                    n_new = trace.update()
+                except sqlite3.Error as e:
+                    print(f"  [Error] Could not read database {trace.db_path}: {e}")
+                    continue
+                if n_new == 0 or (not trace.best and i not in lines):
+                    continue
+                changed = True
+                if i not in lines:
+                    lines[i], = ax.plot([], [], marker='o', linestyle='-', markersize=4)
+                best = np.array(trace.best)
+                lines[i].set_data(np.arange(1, len(best) + 1), best - best[-1] if len(best) else best)
+                lines[i].set_label(f'{ion_type}{i} ({len(best)} candidates)')
+                if len(best):
+                    print(f"{time.strftime('%Y-%m-%d %H:%M:%S')} {ion_type}{i}: {len(best)} candidates, "
+                          f"lowest energy {best[-1]:.4f} eV", flush=True)
+                if series_path and len(best):
+                    new_file = not os.path.isfile(series_path)
+                    with open(series_path, 'a', newline='') as f:
+                        writer = csv.writer(f)
+                        if new_file:
+                            writer.writerow(['time', f'{ion_type}_count', 'candidates', 'lowest_energy'])
+                        writer.writerow([round(time.time()), i, len(best), best[-1]])
+
+            if changed:
+                ax.relim()
+                ax.autoscale_view()
+                ax.legend(title="Ion Intercalation Count")
+                if save_path:
+                    fig.savefig(save_path, dpi=300)
+            if save_path:
+                time.sleep(interval)
+            else:
+                plt.pause(interval)
+    except KeyboardInterrupt:
+        print("\nStopped following.")
+
+
 def monitor_ga_runs(ion_type, lower_bound, upper_bound, save_path=None):
     """
     Monitors the convergence of genetic algorithm runs by plotting the
@@ -17,6 +162,8 @@ def monitor_ga_runs(ion_type, lower_bound, upper_bound, save_path=None):
         save_path (str, optional): Path to save the plot image. If None,
                                    the plot is displayed interactively.
     """
+    import matplotlib.pyplot as plt
+
     print("--- Starting GA Convergence Analysis ---")
     
     # --- Set up the plot ---
@@ -47,42 +194,20 @@ def monitor_ga_runs(ion_type, lower_bound, upper_bound, save_path=None):
             print("  No relaxed candidates found in the database. Skipping.")
             continue
 
-        # --- Extract confid and energy, then sort by confid ---
-        candidate_data = []
-        for cand in all_candidates:
-            try:
-                confid = cand.info['confid']
-                energy = cand.get_potential_energy()
-                candidate_data.append((confid, energy))
-            except (KeyError, AttributeError):
-                print(f"  [Warning] Skipping a candidate with missing 'confid' or energy.")
-        
+        # --- Extract confid and energy, sorted by confid ---
+        candidate_data = candidate_energies(all_candidates)
+
         if not candidate_data:
             print("  No valid candidates with confid and energy found. Skipping.")
             continue
-            
-        # Sort candidates based on their ID number
-        candidate_data.sort(key=lambda x: x[0])
 
         # --- Find overall minimum energy for this run to set the 0 eV reference ---
         all_energies = [data[1] for data in candidate_data]
         min_energy_for_run = min(all_energies)
 
-        # --- Process energies and find the running minimum relative energy ---
-        plot_indices = []
-        plot_relative_energies = []
-        lowest_energy_so_far = float('inf')
-
-        for index, (confid, energy) in enumerate(candidate_data):
-            if energy < lowest_energy_so_far:
-                lowest_energy_so_far = energy
-            
-            # Calculate the relative energy with respect to the run's best energy
-            relative_energy = lowest_energy_so_far - min_energy_for_run
-            
-            # Use the sorted index (plus 1) for the x-axis
-            plot_indices.append(index + 1)
-            plot_relative_energies.append(relative_energy)
+        # --- The running minimum relative energy, with the sorted index (plus 1) on the x-axis ---
+        plot_indices = list(range(1, len(candidate_data) + 1))
+        plot_relative_energies = list(running_minimum(all_energies) - min_energy_for_run)
 
         # --- Add this run's data to the plot ---
         if plot_indices:
@@ -144,6 +269,31 @@ if __name__ == '__main__':
         help='Optional: Save the plot to a file (e.g., "convergence.png") instead of displaying it.'
     )
     
+    parser.add_argument(
+        '--follow',
+        action='store_true',
+        help='Keep running and refresh the plot every --interval seconds, reading only new candidates.\n'
+             'Candidates are then counted in the order they finished relaxing.'
+    )
+    parser.add_argument(
+        '--interval',
+        type=float,
+        default=60.,
+        metavar='SECONDS',
+        help='Seconds between refreshes with --follow (default: 60).'
+    )
+    parser.add_argument(
+        '--series',
+        type=str,
+        default=None,
+        metavar='FILENAME',
+        help='Optional, with --follow: append the lowest energy of each run to this CSV file when it changes.'
+    )
+
     args = parser.parse_args()
-    
-    monitor_ga_runs(args.ion_type, args.lower_bound, args.upper_bound, args.save_plot)
+
+    if args.follow:
+        follow_ga_runs(args.ion_type, args.lower_bound, args.upper_bound, args.save_plot,
+                       args.interval, args.series)
+    else:
+        monitor_ga_runs(args.ion_type, args.lower_bound, args.upper_bound, args.save_plot)
@@ -0,0 +1,69 @@
+"""
+Background producer of new GA candidates for main_run.py.
+
+Making an offspring (pairing, surrogate screening, mutation, pre-relaxation)
+can take a while, so a thread keeps up to OFFSPRING_BUFFER_SIZE of them ready
+and the driver only pops one when a slot frees up. A thread rather than a
+process pool: the operators hold numpy.random (not picklable) and share the
+population with the driver, and the driver itself is idle most of the time.
+"""
+import queue
+import threading
+
+
+class ProducerStarved(RuntimeError):
+    """produce() failed max_failures times in a row"""
+
+
+class OffspringBuffer(threading.Thread):
+    """
+    Calls produce() in the background and keeps up to size of its results.
+    produce() returns an item, or None if the attempt failed (it is called
+    again). An exception in produce() is raised again by pop(), and so is
+    ProducerStarved once max_failures attempts in a row have failed (e.g. the
+    pre-relaxation or the duplicate check rejects everything).
+    """
+    def __init__(self, produce, size=4, max_failures=None):
+        super().__init__(daemon=True)
+        self.produce = produce
+        self.items = queue.Queue(maxsize=size)
+        self.max_failures = max_failures
+        self.n_failures = 0  # in a row
+        self.error = None
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            try:
+                item = self.produce()
+            except Exception as e:
+                self.error = e
+                return
+            if item is None:
+                self.n_failures += 1
+                if self.max_failures is not None and self.n_failures >= self.max_failures:
+                    self.error = ProducerStarved(f'{self.n_failures} attempts in a row produced nothing')
+                    return
+                continue
+            self.n_failures = 0
+            while not self._stop_event.is_set():
+                try:
+                    self.items.put(item, timeout=1)
+                    break
+                except queue.Full:
+                    continue
+
+    def pop(self):
+        """Returns the oldest item, waiting for one if the buffer is empty."""
+        while True:
+            if self.error is not None:
+                raise self.error
+            try:
+                return self.items.get(timeout=1)
+            except queue.Empty:
+                if not self.is_alive() and self.error is None:
+                    raise RuntimeError('The offspring producer has stopped')
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
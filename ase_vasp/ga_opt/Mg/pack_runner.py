@@ -0,0 +1,80 @@
+"""
+Runs several calc.py relaxations side by side inside one SLURM allocation.
+
+SLURMQueueRun (with pack_size > 1) hands candidates over as empty marker files
+in <tmp_folder>/pending/. Each free slot claims one by renaming its marker into
+<tmp_folder>/claimed/ (atomic, so two allocations never get the same candidate)
+and runs calc.py on it with SLURM_NTASKS // slots MPI ranks. "{ranks}" in
+ASE_VASP_COMMAND is replaced by that number. When a relaxation finishes, the
+slot claims the next pending candidate. The runner exits once nothing is
+pending and all slots have been idle for idle_timeout seconds.
+
+Run from the Mg-$i directory: python ../pack_runner.py <tmp_folder> <slots>
+"""
+import argparse
+import os
+import subprocess
+import time
+
+
+def claim(tmp_folder, job_name):
+    """Moves the first pending marker to claimed/ and returns its name (e.g. 'cand12'), or None."""
+    pending_dir = os.path.join(tmp_folder, 'pending')
+    for marker in sorted(os.listdir(pending_dir)):
+        claimed = os.path.join(tmp_folder, 'claimed', marker)
+        try:
+            os.rename(os.path.join(pending_dir, marker), claimed)
+        except FileNotFoundError:
+            continue  # another allocation was faster
+        with open(claimed, 'w') as f:
+            f.write(job_name)  # lets the driver tell whether the owner is still alive
+        return marker
+    return None
+
+
+def main(tmp_folder, slots, idle_timeout=60, check_interval=5):
+    ranks = max(int(os.environ.get('SLURM_NTASKS', slots)) // slots, 1)
+    env = dict(os.environ)
+    env['ASE_VASP_COMMAND'] = os.environ['ASE_VASP_COMMAND'].replace('{ranks}', str(ranks))
+    job_name = os.environ.get('SLURM_JOB_NAME', '')
+    job_id = os.environ.get('SLURM_JOB_ID', '0')
+    os.makedirs(os.path.join(tmp_folder, 'pending'), exist_ok=True)
+    os.makedirs(os.path.join(tmp_folder, 'claimed'), exist_ok=True)
+    print(f"{slots} slots with {ranks} ranks each: {env['ASE_VASP_COMMAND']}", flush=True)
+
+    running = {}  # marker -> (process, log file)
+    idle_since = time.monotonic()
+    while True:
+        for marker, (p, log) in list(running.items()):
+            if p.poll() is not None:
+                log.close()
+                os.remove(os.path.join(tmp_folder, 'claimed', marker))
+                del running[marker]
+                print(f"{marker} finished with exit code {p.returncode}", flush=True)
+
+        while len(running) < slots:
+            marker = claim(tmp_folder, job_name)
+            if marker is None:
+                break
+            traj_file = os.path.join(tmp_folder, marker + '.traj')
+            log = open(os.path.join(tmp_folder, f'{marker}_{job_id}.log'), 'w')
+            running[marker] = (subprocess.Popen(['python', 'calc.py', traj_file], env=env,
+                                                stdout=log, stderr=subprocess.STDOUT), log)
+            print(f"Started {marker}", flush=True)
+
+        if running:
+            idle_since = time.monotonic()
+        elif time.monotonic() - idle_since > idle_timeout:
+            break
+        time.sleep(check_interval)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run several calc.py relaxations in one allocation.")
+    parser.add_argument('tmp_folder', type=str, help='Folder with the candidate .traj files.')
+    parser.add_argument('slots', type=int, help='Number of concurrent relaxations.')
+    parser.add_argument('--idle_timeout', type=float, default=60,
+                        help='Seconds to wait for new candidates before exiting.')
+    args = parser.parse_args()
+
+    main(args.tmp_folder, args.slots, args.idle_timeout)
@@ -9,13 +9,22 @@ from scipy.interpolate import make_interp_spline, interp1d
 from scipy.optimize import curve_fit
 import ase
 from ase.io import read, write
+from convex_hull import ConvexHull
 
 plt.rcParams.update({'font.size': 18, 'font.family': 'Arial', 'figure.figsize':(9,6)})
 ion = 'Mg'
+n_full = 12  # as in extract_ga_energy
 data = pd.read_csv(f'{ion}_ga_energy.csv')
 
+# the formation energies are already relative to the references
+hull = ConvexHull(0., 0., n_full)
+hull.add(data[f'{ion}_count'], data['Form Energy'])
+on_hull = hull.e_above_hull(data[f'{ion}_count'], data['Form Energy']) < 1e-6
+
 fig, ax = plt.subplots()
 ax.scatter(data[f'{ion}_count']/32, data['Form Energy'], color = 'grey')
+ax.plot(hull.vertices[:, 0]/32, hull.vertices[:, 1], color = 'black')
+ax.scatter(data[f'{ion}_count'][on_hull]/32, data['Form Energy'][on_hull], color = 'red', zorder = 3)
 
 
 ax.set_ylabel('Formation energy (eV)', fontweight="bold")
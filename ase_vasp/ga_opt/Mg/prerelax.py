@@ -0,0 +1,67 @@
+"""
+Cheap pre-relaxation of new GA candidates before they are sent to VASP.
+
+main_run.py (with PRERELAX = True) relaxes each offspring locally with a cheap
+calculator (any ML potential with an ASE calculator interface, or EMT for the
+few elements it knows) for a capped number of steps. Candidates that collapse, explode or end up with atoms
+closer than blmin are discarded; the others are relaxed by VASP starting from
+the pre-relaxed geometry, which needs fewer ionic steps.
+"""
+from ase.ga.utilities import atoms_too_close
+from ase.optimize import BFGS
+import numpy as np
+
+try:
+    from ase.filters import FrechetCellFilter as CellFilter
+except ImportError:  # ASE < 3.23
+    from ase.constraints import ExpCellFilter as CellFilter
+
+
+def check_calculator(calc, atoms):
+    """
+    Raises ValueError if calc cannot give a finite energy for atoms, e.g. EMT
+    for elements it has no parameters for. Otherwise prerelax() would quietly
+    discard every candidate.
+    """
+    probe = atoms.copy()
+    probe.calc = calc
+    try:
+        energy = probe.get_potential_energy()
+    except Exception as e:
+        raise ValueError(f"The pre-relaxation calculator ({calc.name}) cannot evaluate "
+                         f"{probe.get_chemical_formula()}: {e}") from e
+    if not np.isfinite(energy):
+        raise ValueError(f"The pre-relaxation calculator ({calc.name}) gives a non-finite energy "
+                         f"for {probe.get_chemical_formula()}")
+
+
+def prerelax(atoms, calc, blmin, fmax=0.1, steps=200, relax_cell=True,
+             min_volume_ratio=0.5, max_volume_ratio=2.0):
+    """
+    Relaxes a copy of atoms with calc (and its cell, if relax_cell) for at
+    most steps BFGS steps.
+
+    Returns (relaxed atoms, 'ok'), or (None, reason) if the candidate should be
+    discarded: the calculator failed, the energy or positions are not finite,
+    the volume changed by more than min_volume_ratio / max_volume_ratio
+    (collapse / explosion), or two atoms are closer than blmin.
+    """
+    relaxed = atoms.copy()
+    relaxed.calc = calc
+    try:
+        BFGS(CellFilter(relaxed) if relax_cell else relaxed, logfile=None).run(fmax=fmax, steps=steps)
+        energy = relaxed.get_potential_energy()
+    except Exception as e:
+        return None, f'calculator failed ({e})'
+    relaxed.calc = None
+
+    if not np.isfinite(energy) or not np.isfinite(relaxed.positions).all():
+        return None, 'exploded (non-finite energy or positions)'
+    volume_ratio = relaxed.get_volume() / atoms.get_volume()
+    if volume_ratio < min_volume_ratio:
+        return None, f'collapsed (volume x{volume_ratio:.2f})'
+    if volume_ratio > max_volume_ratio:
+        return None, f'exploded (volume x{volume_ratio:.2f})'
+    if atoms_too_close(relaxed, blmin):
+        return None, 'atoms closer than blmin'
+    return relaxed, 'ok'
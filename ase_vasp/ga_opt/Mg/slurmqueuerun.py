@@ -1,22 +1,201 @@
+from ase.ga import set_raw_score
 from ase.ga.pbs_queue_run import PBSQueueRun
-from ase.io import write
-from subprocess import Popen, PIPE
+from ase.io import read, write
+from subprocess import Popen, PIPE, call
+from glob import glob
+import asyncio
+import math
 import os
+import time
+
+try:
+    from inotify_simple import INotify, flags as inotify_flags
+except ImportError:  # fall back to polling the folder
+    INotify = None
+
+PACK_RUNNER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pack_runner.py')
+
+
+class DoneFileWatcher:
+    """Wakes an asyncio loop when new *_done.traj files appear in a folder.
+
+    Uses inotify (inotify_simple package) if it is installed, otherwise
+    lists the folder every poll_interval seconds.
+    """
+    def __init__(self, folder, poll_interval=5.0):
+        os.makedirs(folder, exist_ok=True)
+        self.folder = folder
+        self.poll_interval = poll_interval
+        self.seen = set(self._done_files())
+        self.inotify = None
+        if INotify is not None:
+            self.inotify = INotify()
+            self.inotify.add_watch(folder, inotify_flags.CLOSE_WRITE | inotify_flags.MOVED_TO)
+
+    def _done_files(self):
+        return glob(os.path.join(self.folder, '*_done.traj'))
+
+    def new_files(self):
+        new = set(self._done_files()) - self.seen
+        self.seen |= new
+        return sorted(new)
+
+    async def wait(self, timeout):
+        """Returns the new _done.traj files, or [] if none appeared within timeout seconds."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            new = self.new_files()
+            remaining = deadline - loop.time()
+            if new or remaining <= 0:
+                return new
+            if self.inotify is None:
+                await asyncio.sleep(min(self.poll_interval, remaining))
+                continue
+            event = asyncio.Event()
+            loop.add_reader(self.inotify.fd, event.set)
+            try:
+                await asyncio.wait_for(event.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                loop.remove_reader(self.inotify.fd)
+            self.inotify.read(timeout=0)  # drain the events, new_files() does the rest
+
+    def close(self):
+        if self.inotify is not None:
+            self.inotify.close()
+
+
+async def wait_any(watchers, timeout):
+    """Returns [(index of watcher, new _done.traj file)] once any of the watchers sees new files, or [] after timeout seconds."""
+    tasks = [asyncio.ensure_future(watcher.wait(timeout)) for watcher in watchers]
+    done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+    return [(i, fname) for i, task in enumerate(tasks) if task in done for fname in task.result()]
+
+
+async def drive_runs(runs, submit, poll_interval=60.0):
+    """Event-driven replacement for sleep-polling the queue, for one or more SLURMQueueRuns.
+
+    Every tick calls submit(), which should submit jobs until the free
+    slots are filled and return True while it still has work left. Then it
+    sleeps until a new _done.traj appears in the tmp_folder of any of the
+    runs, ingests it and starts the next tick. poll_interval bounds the sleep
+    so that jobs which died without writing a _done.traj are still noticed
+    through squeue.
+
+    Returns once submit() returns False and no jobs are running, with
+    whether there was anything to do at all.
+    """
+    watchers = [DoneFileWatcher(run.tmp_folder) for run in runs]
+    for run in runs:
+        run.__cleanup__()  # anything that finished before the watchers started
+    busy = False
+    try:
+        while True:
+            more = submit()
+            for run in runs:
+                if run.pack_size > 1 and run.submit_pack_jobs():
+                    raise ValueError("Failed to submit packed allocation")
+            n_running = sum(run.number_of_jobs_running() for run in runs)
+            if not more and n_running == 0:
+                return busy
+            busy = True
+            print(f'{n_running} jobs running', flush=True)
+            for i, fname in await wait_any(watchers, poll_interval):
+                runs[i].ingest_done_file(fname)
+    finally:
+        for watcher in watchers:
+            watcher.close()
+
+
+class SlurmQueue:
+    """Snapshot of squeue (all jobs of this user), refreshed at most once per ttl seconds.
+
+    One instance can be shared by several SLURMQueueRuns (e.g. one per
+    composition), so that they make a single squeue call per cycle.
+    """
+    def __init__(self, qstat_command='squeue', ttl=5.0):
+        self.qstat_command = qstat_command
+        self.qstat_flags = '-o "%.18i %.100j %.8u %.2t %.10M %.6D %R"'  # full job name (100 chars)
+        self.ttl = ttl  # seconds
+        self._state = None
+        self.time = float('-inf')  # time.monotonic() of the snapshot
+
+    def invalidate(self):
+        """Forces the next query to call squeue again (e.g. after a submission)."""
+        self.time = float('-inf')
+
+    def state(self):
+        """Returns {job name: state} of all jobs of this user."""
+        if self._state is not None and time.monotonic() - self.time < self.ttl:
+            return self._state
+        p = Popen([f'`which {self.qstat_command}` -u `whoami` {self.qstat_flags}'],
+                  shell=True, stdin=PIPE, stdout=PIPE, stderr=PIPE,
+                  close_fds=True, universal_newlines=True)
+        out, err = p.communicate()
+        if p.returncode != 0:
+            print(f"{self.qstat_command} failed: {err.strip()}", flush=True)
+            if self._state is not None:
+                return self._state  # keep the last snapshot, retry on the next call
+
+        state = {}
+        for line in out.splitlines():
+            fields = line.split()
+            if len(fields) >= 4:
+                state[fields[1]] = fields[3]
+        self._state = state
+        self.time = time.monotonic()
+        return state
 
 
 class SLURMQueueRun(PBSQueueRun):
-    """ASE PBSQueueRun with SLURM sucks."""
+    """ASE PBSQueueRun with SLURM sucks.
+
+    The queue is read with a single squeue call per qstat_ttl seconds (or
+    through a SlurmQueue shared with other runs, given as queue). All query
+    methods read from that snapshot, and submitting a job invalidates it.
+    Jobs whose _done.traj was already ingested count as finished even while
+    squeue still lists them, so their slot can be refilled right away.
+
+    With pack_size > 1, candidates are not submitted as their own jobs.
+    Instead they are queued as marker files in tmp_folder/pending/ and
+    allocations built by pack_template_generator(job_name, runner_command)
+    run pack_size of them at a time through pack_runner.py, refilling a slot
+    whenever a relaxation finishes. n_relax and n_ga then count candidates,
+    and enough allocations are submitted to hold all queued candidates.
+
+    Jobs are submitted from submit_dir, the directory with calc.py.
+
+    raw_score_function(atoms), if given, replaces the raw_score that calc.py
+    wrote for each relaxed structure before it is added to the database.
+    Structures calc.py marked failed (no energy) are added as extinct.
+    """
     def __init__(self, data_connection, tmp_folder, job_prefix,
                  n_relax, n_ga, job_template_generator,
                  qsub_command='sbatch', qstat_command='squeue',
-                 find_neighbors=None, perform_parametrization=None):
+                 find_neighbors=None, perform_parametrization=None,
+                 qstat_ttl=5.0, pack_size=1, pack_template_generator=None,
+                 queue=None, submit_dir='.', raw_score_function=None):
+        if pack_size > 1 and pack_template_generator is None:
+            raise ValueError("pack_size > 1 needs a pack_template_generator")
+        self.pack_size = pack_size
+        self.pack_template_generator = pack_template_generator
+        self.queue = queue if queue is not None else SlurmQueue(qstat_command, qstat_ttl)
+        self.submit_dir = submit_dir
+        self.raw_score_function = raw_score_function
+        self._queue_state = None
+        self._queue_state_time = None  # SlurmQueue.time of the snapshot _queue_state was taken from
+        self.finished_jobs = set()
         super(SLURMQueueRun, self).__init__(data_connection, tmp_folder,
                                             job_prefix, n_ga,
                                             job_template_generator,
                                             qsub_command, qstat_command,
                                             find_neighbors, perform_parametrization)
         self.n_relax = n_relax
-        self.qstat_flags = '-o "%.18i %.100j %.8u %.2t %.10M %.6D %R"'  # full job name (100 chars)
     
     def relax(self, a):
         """Copy from parent class, but returns SLURM submission exit code"""
@@ -27,37 +206,139 @@ class SLURMQueueRun(PBSQueueRun):
         fname = '{}/cand{}.traj'.format(self.tmp_folder,
                                         a.info['confid'])
         write(fname, a)
+        if self.pack_size > 1:
+            os.makedirs(os.path.join(self.tmp_folder, 'pending'), exist_ok=True)
+            open(os.path.join(self.tmp_folder, 'pending', 'cand{}'.format(a.info['confid'])), 'w').close()
+            return self.submit_pack_jobs()
         job_name = '{}_{}'.format(self.job_prefix, a.info['confid'])
-        with open('tmp_job_file.job', 'w') as fd:
-            fd.write(self.job_template_generator(job_name, fname))
-        c = os.system(f'{self.qsub_command} tmp_job_file.job')
+        # calc.py runs in submit_dir and names its VASP folder after the (relative) .traj path
+        return self._submit(self.job_template_generator(job_name, os.path.relpath(fname, self.submit_dir)))
+
+    def _submit(self, job_script):
+        with open(os.path.join(self.submit_dir, 'tmp_job_file.job'), 'w') as fd:
+            fd.write(job_script)
+        c = call(f'{self.qsub_command} tmp_job_file.job', shell=True, cwd=self.submit_dir)
+        self.invalidate_queue_state()
         return c  # 0 if successful
 
+    def _pack_jobs(self):
+        return [job for job in self.queue_state() if job.startswith(self.job_prefix + '_pack')]
+
+    def packed_candidates(self):
+        """Returns the confids that are pending or claimed by a live allocation (pack mode).
+
+        Claimed candidates whose allocation is gone are moved back to pending,
+        so calc.py resumes them from their CONTCAR in the next allocation.
+        """
+        pending_dir = os.path.join(self.tmp_folder, 'pending')
+        claimed_dir = os.path.join(self.tmp_folder, 'claimed')
+        os.makedirs(pending_dir, exist_ok=True)
+        os.makedirs(claimed_dir, exist_ok=True)
+        alive = set(self._pack_jobs())
+        in_queue = set(self.dc.get_all_candidates_in_queue())
+        candidates = []
+        for marker in os.listdir(claimed_dir):
+            try:
+                with open(os.path.join(claimed_dir, marker)) as f:
+                    owner = f.read().strip()
+                if owner and owner not in alive:
+                    os.rename(os.path.join(claimed_dir, marker), os.path.join(pending_dir, marker))
+            except FileNotFoundError:
+                continue  # finished and removed by pack_runner.py in the meantime
+        for marker in os.listdir(claimed_dir):
+            if int(marker[len('cand'):]) in in_queue:
+                candidates.append(int(marker[len('cand'):]))
+        for marker in os.listdir(pending_dir):
+            if int(marker[len('cand'):]) in in_queue:
+                candidates.append(int(marker[len('cand'):]))
+            else:  # no longer queued, must not be run
+                try:
+                    os.remove(os.path.join(pending_dir, marker))
+                except FileNotFoundError:
+                    pass
+        return candidates
+
+    def submit_pack_jobs(self):
+        """Submits allocations until there is a slot for every packed candidate."""
+        n_needed = math.ceil(len(self.packed_candidates()) / self.pack_size)
+        runner_command = f'python {PACK_RUNNER} {os.path.relpath(self.tmp_folder, self.submit_dir)} {self.pack_size}'
+        for _ in range(n_needed - len(self._pack_jobs())):
+            job_name = '{}_pack{}'.format(self.job_prefix, time.time_ns())
+            c = self._submit(self.pack_template_generator(job_name, runner_command))
+            if c:
+                return c
+        return 0
+
     def enough_jobs_running_ga(self):
         return super().enough_jobs_running()
         
     def enough_jobs_running_relax(self):
         return self.number_of_jobs_running() >= self.n_relax
-    
+
+    def invalidate_queue_state(self):
+        """Forces the next query to call squeue again (e.g. after a submission)."""
+        self.queue.invalidate()
+
+    def queue_state(self):
+        """Returns {job name: state} of this run's jobs, calling squeue at most once per qstat_ttl."""
+        state = self.queue.state()
+        if self._queue_state is None or self.queue.time != self._queue_state_time:
+            self.__cleanup__()
+            self._queue_state = {name: s for name, s in state.items() if name.startswith(self.job_prefix + '_')}
+            self._queue_state_time = self.queue.time
+            self.finished_jobs &= set(self._queue_state)  # forget jobs that left the queue
+        return self._queue_state
+
     def relevant_jobs(self):
-        self.__cleanup__()
-        p = Popen([f'`which {self.qstat_command}` -u `whoami` {self.qstat_flags}'],
-                  shell=True, stdin=PIPE, stdout=PIPE, stderr=PIPE,
-                  close_fds=True, universal_newlines=True)
-        fout = p.stdout
-        lines = fout.readlines()
-        myjobs = []
-        for line in lines:
-            if line.find(self.job_prefix + '_') != -1:
-                myjobs.append(line)
-        return myjobs
+        return [job for job in self.queue_state() if job not in self.finished_jobs]
 
     def number_of_jobs_running(self):
+        if self.pack_size > 1:
+            return len(self.packed_candidates())
         return len(self.relevant_jobs())
 
     def is_running(self, aid):
+        if self.pack_size > 1:
+            return aid in self.packed_candidates()
         job_name = '{}_{}'.format(self.job_prefix, aid)
-        for job in self.relevant_jobs():
-            if job_name in job:
-                return True
-        return False
+        return job_name in self.queue_state() and job_name not in self.finished_jobs
+
+    def __cleanup__(self):
+        """Loads the structures of queued candidates that have finished (see ingest_done_file)."""
+        for confid in self.dc.get_all_candidates_in_queue():
+            fname = '{}/cand{}_done.traj'.format(self.tmp_folder, confid)
+            if os.path.isfile(fname) and os.path.getsize(fname) > 0:
+                self.ingest_done_file(fname)
+
+    def ingest_done_file(self, fname):
+        """Adds the relaxed structure in tmp_folder/cand{confid}_done.traj to the database."""
+        confid = int(os.path.basename(fname)[len('cand'):-len('_done.traj')])
+        if confid not in self.dc.get_all_candidates_in_queue():
+            return  # already ingested
+        a = []
+        for _ in range(5):  # the file may still be being written
+            try:
+                a = read(fname, ':')
+            except Exception:
+                a = []
+            if len(a) > 0:
+                break
+            time.sleep(1.)
+        if len(a) == 0:
+            print(f'Could not read candidate {confid} from the filesystem', flush=True)
+            return
+        a = a[-1]
+        a.info['confid'] = confid
+        failed = a.info['key_value_pairs'].get('failed', False)  # calc.py found no energy
+        a.info['key_value_pairs'].setdefault('extinct', 0)  # the population only reads extinct=0 rows
+        if self.raw_score_function is not None and not failed:
+            set_raw_score(a, self.raw_score_function(a))
+        self.dc.add_relaxed_step(a, find_neighbors=self.find_neighbors,
+                                 perform_parametrization=self.perform_parametrization)
+        if failed:
+            self.dc.kill_candidate(confid)  # extinct: counts as tested, never in the population
+        self.finished_jobs.add('{}_{}'.format(self.job_prefix, confid))
+
+    async def drive(self, submit, poll_interval=60.0):
+        """drive_runs() for this run alone."""
+        return await drive_runs([self], submit, poll_interval)
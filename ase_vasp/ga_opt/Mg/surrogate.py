@@ -0,0 +1,114 @@
+"""
+Surrogate model used by main_run.py (SURROGATE = True) to screen offspring.
+
+Each structure is described by a fixed-length fingerprint (Gaussian-smeared
+pair-distance histograms, one per pair of element types), and the relaxed
+energies in gadb.db are fitted with kernel ridge regression (RBF kernel). The
+driver generates a pool of offspring per free slot and only submits the one
+with the lowest predicted energy, optionally lowered by kappa times the
+prediction uncertainty to favor structures unlike anything relaxed so far.
+"""
+from ase.neighborlist import neighbor_list
+import numpy as np
+
+
+class PairDistanceFingerprint:
+    """
+    Gaussian-smeared histograms of the interatomic distances up to r_cut for
+    each pair of element types in atom_types, concatenated and divided by the
+    number of atoms. Periodic images are included.
+    """
+    def __init__(self, atom_types, r_cut=6.0, n_bins=60, sigma=0.1):
+        self.atom_types = sorted(set(atom_types))
+        self.r_cut = r_cut
+        self.sigma = sigma
+        self.bins = np.linspace(0, r_cut, n_bins)
+        n_types = len(self.atom_types)
+        # index of each (unordered) pair of types
+        self.pair_index = -np.ones((max(self.atom_types) + 1,) * 2, int)
+        k = 0
+        for a in range(n_types):
+            for b in range(a, n_types):
+                za, zb = self.atom_types[a], self.atom_types[b]
+                self.pair_index[za, zb] = self.pair_index[zb, za] = k
+                k += 1
+        self.n_pairs = k
+
+    def __len__(self):
+        return self.n_pairs * len(self.bins)
+
+    def __call__(self, atoms):
+        i, j, d = neighbor_list('ijd', atoms, self.r_cut)
+        numbers = atoms.get_atomic_numbers()
+        pairs = self.pair_index[numbers[i], numbers[j]]
+        smeared = np.exp(-0.5 * ((self.bins[None, :] - d[:, None]) / self.sigma) ** 2)
+        fingerprint = np.zeros((self.n_pairs, len(self.bins)))
+        np.add.at(fingerprint, pairs, smeared)
+        return fingerprint.ravel() / len(atoms)
+
+
+class KernelRidgeSurrogate:
+    """
+    Kernel ridge regression of the relaxed energy on a
+    fingerprint, with the uncertainty of the equivalent Gaussian process.
+
+    update() only computes fingerprints of candidates it has not seen yet
+    (by confid) and refits, so it can be called whenever results arrive.
+
+    Args:
+        fingerprint: callable mapping Atoms to a 1D array
+        alpha (float): regularization (noise) relative to the kernel amplitude
+        length_scale (float, optional): RBF length scale in fingerprint space.
+            Default: median distance between training fingerprints.
+    """
+    def __init__(self, fingerprint, alpha=1e-3, length_scale=None):
+        self.fingerprint = fingerprint
+        self.alpha = alpha
+        self.fixed_length_scale = length_scale
+        self.confids = []
+        self.X = np.zeros((0, len(fingerprint)))
+        self.y = np.zeros(0)
+
+    @property
+    def n_train(self):
+        return len(self.y)
+
+    def update(self, candidates):
+        """Adds relaxed candidates (with confid and energy) that are not in the training set yet and refits."""
+        known = set(self.confids)
+        new = [a for a in candidates if a.info['confid'] not in known]
+        if not new:
+            return 0
+        self.confids += [a.info['confid'] for a in new]
+        self.X = np.vstack([self.X, [self.fingerprint(a) for a in new]])
+        self.y = np.append(self.y, [a.get_potential_energy() for a in new])
+        self.fit()
+        return len(new)
+
+    @staticmethod
+    def _sq_dist(X1, X2):
+        return np.maximum((X1 ** 2).sum(1)[:, None] + (X2 ** 2).sum(1)[None, :] - 2 * X1 @ X2.T, 0)
+
+    def _kernel(self, X1, X2):
+        return np.exp(-0.5 * self._sq_dist(X1, X2) / self.length_scale ** 2)
+
+    def fit(self):
+        self.y_mean = self.y.mean()
+        self.y_std = self.y.std() if self.y.std() > 0 else 1.0
+        if self.fixed_length_scale is not None:
+            self.length_scale = self.fixed_length_scale
+        else:
+            dist = np.sqrt(self._sq_dist(self.X, self.X)[np.triu_indices(self.n_train, 1)])
+            self.length_scale = np.median(dist) if len(dist) and np.median(dist) > 0 else 1.0
+        K = self._kernel(self.X, self.X) + self.alpha * np.eye(self.n_train)
+        self.L = np.linalg.cholesky(K)
+        self.weights = np.linalg.solve(self.L.T, np.linalg.solve(self.L, (self.y - self.y_mean) / self.y_std))
+
+    def predict(self, structures):
+        """Returns the predicted energies and their uncertainties (eV) of a list of Atoms."""
+        X = np.array([self.fingerprint(a) for a in structures])
+        k = self._kernel(X, self.X)
+        mean = k @ self.weights * self.y_std + self.y_mean
+        v = np.linalg.solve(self.L, k.T)
+        std = np.sqrt(np.maximum(1 - (v ** 2).sum(0), 0)) * self.y_std
+        return mean, std
@@ -1,34 +1,163 @@
 from ase.io.trajectory import Trajectory
+from ase.io import ulm
 from ase.io.ulm import InvalidULMFileError
-import sys, os
+import numpy as np
+import fcntl, json, sys, os
 
 
-job_array_len = int(sys.argv[1])
-out_traj_prefix= sys.argv[2]
+def append_new_images(src_name, dst_name, n_done):
+    """Appends the images of src_name after the first n_done to dst_name. Returns the number of images in src_name."""
+    src = Trajectory(src_name, 'r')
+    n_images = len(src)
+    if n_images > n_done:
+        dst = Trajectory(dst_name, 'a')
+        for i in range(n_done, n_images):
+            dst.write(src[i])
+        dst.close()
+    src.close()
+    return n_images
 
-conv_traj_name = out_traj_prefix + "_ef.traj"
-unconv_traj_name = out_traj_prefix + "_unconv.traj"
 
-conv_traj = Trajectory(conv_traj_name, 'w')
-unconv_traj = Trajectory(unconv_traj_name, 'w')
+def read_traj_header(traj_name):
+    """
+    Returns the header (pbc, numbers, masses, constraints) that images of the
+    trajectory without their own header are read with, or None if it is empty.
+    Raises InvalidULMFileError / OSError if traj_name is not an ASE trajectory.
+    """
+    with Trajectory(traj_name, 'r') as traj:
+        if len(traj) == 0:
+            return None
+        return traj.pbc, traj.numbers, traj.masses, traj.constraints
 
 
-for i in range(job_array_len):
-    try:
-        conv_traj_i = Trajectory( os.path.join(str(i), conv_traj_name), 'r' )
-        for image in conv_traj_i:
-            conv_traj.write(image)
-        conv_traj_i.close()
-    except InvalidULMFileError:
-        print(f"{os.path.join(str(i), 'Pt_ef.traj')} is not a valid ULM file. Skipping...")
+def headers_equal(header1, header2):
+    return all(np.array_equal(a, b) for a, b in zip(header1, header2))
 
-    try:
-        unconv_traj_i = Trajectory( os.path.join(str(i), unconv_traj_name), 'r' )
-        for image in unconv_traj_i:
-            unconv_traj.write(image)
-        unconv_traj_i.close()
-    except InvalidULMFileError:
-        print(f"{os.path.join(str(i), 'Pt_unconv.traj')} is not a valid ULM file. Skipping...")
 
-conv_traj.close()
-unconv_traj.close()
+def _copy_ulm_arrays(src_fd, data, dst_fd):
+    """
+    Copies the bytes of every ndarray referenced in the (nested) ULM item
+    dictionary data from src_fd to the end of dst_fd, and points data at the copies.
+    """
+    for key, value in data.items():
+        if not key.endswith('.'):
+            continue
+        if 'ndarray' in value:
+            shape, dtype, offset = value['ndarray']
+            src_fd.seek(offset)
+            nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+            value['ndarray'] = [shape, dtype, ulm.align(dst_fd)]
+            dst_fd.write(src_fd.read(nbytes))
+        else:
+            _copy_ulm_arrays(src_fd, value, dst_fd)
+
+
+def copy_ulm_items(src_name, dst_name, n_done):
+    """
+    Appends the items of the ULM file src_name after the first n_done to
+    dst_name by copying their raw bytes and rewriting only the small JSON part
+    of each item (array offsets) and the offset table of dst_name.
+    Returns the number of items in src_name.
+    """
+    with open(src_name, 'rb') as src_fd:
+        tag, version, n_items, pos0, offsets = ulm.read_header(src_fd)
+        if version != ulm.VERSION:
+            raise InvalidULMFileError(f"{src_name}: unsupported ULM version {version}")
+        n_items = int(n_items)
+        if n_items <= n_done:
+            return n_items
+
+        dst = ulm.open(dst_name, 'a', tag=tag)
+        try:
+            dst._write_header()  # new file: header goes before the first array
+            for i in range(n_done, n_items):
+                src_fd.seek(offsets[i])
+                size = int(ulm.readints(src_fd, 1)[0])
+                data = json.loads(src_fd.read(size).decode())
+                _copy_ulm_arrays(src_fd, data, dst.fd)
+                dst.data = data
+                dst.sync()
+        finally:
+            dst.close()
+    return n_items
+
+
+def merge_trajectories(paths, out, n_done=None):
+    """
+    Appends the images of the trajectories in paths to out (created if needed)
+    without reading them into Atoms objects: ULM items are copied as raw bytes
+    (see copy_ulm_items). n_done optionally gives, for each path, how many of its
+    leading images to leave out (already merged).
+
+    Images stored without their own header (numbers, pbc, ...) are read with the
+    header of the first image of the file, so items are only copied raw if that
+    header matches the one of out. Other files fall back to decoding and
+    re-writing each image (append_new_images). Files that are not valid
+    trajectories are skipped.
+
+    Returns the number of images in each path (None for skipped files).
+    """
+    if n_done is None:
+        n_done = [0] * len(paths)
+
+    n_images = []
+    for path, n in zip(paths, n_done):
+        try:
+            header = read_traj_header(path)
+            if header is None:
+                n_images.append(0)
+                continue
+            out_header = read_traj_header(out) if os.path.isfile(out) and os.path.getsize(out) > 0 else None
+            if out_header is None:
+                raw = n == 0  # the first copied image must carry the header
+            else:
+                raw = headers_equal(header, out_header)
+            if raw:
+                n_images.append(copy_ulm_items(path, out, n))
+            else:
+                n_images.append(append_new_images(path, out, n))
+        except (InvalidULMFileError, OSError) as err:
+            print(f"{path} is not a valid ULM trajectory ({err}). Skipping...")
+            n_images.append(None)
+    return n_images
+
+
+def merge_tasks(task_ids, out_traj_prefix):
+    """
+    Appends whatever the given array tasks wrote since the last merge to the
+    combined <out_traj_prefix>_ef.traj and _unconv.traj. How many images of
+    each task file are already merged is kept in <out_traj_prefix>_merged.json,
+    so this can run after every task and again at the end without duplicates.
+    Safe to run from several tasks at once.
+    """
+    traj_names = [out_traj_prefix + "_ef.traj", out_traj_prefix + "_unconv.traj"]
+    record_name = out_traj_prefix + "_merged.json"
+
+    with open(out_traj_prefix + "_merge.lock", 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        merged = {}
+        if os.path.isfile(record_name):
+            with open(record_name) as f:
+                merged = json.load(f)
+
+        for traj_name in traj_names:
+            task_traj_names = [os.path.join(str(i), traj_name) for i in task_ids]
+            task_traj_names = [name for name in task_traj_names if os.path.isfile(name)]
+            n_images = merge_trajectories(task_traj_names, traj_name,
+                                          [merged.get(name, 0) for name in task_traj_names])
+            for name, n in zip(task_traj_names, n_images):
+                if n is not None:
+                    merged[name] = n
+
+        with open(record_name + ".tmp", 'w') as f:
+            json.dump(merged, f, indent=1)
+        os.replace(record_name + ".tmp", record_name)
+
+
+if __name__ == '__main__':
+    job_array_len = int(sys.argv[1])
+    out_traj_prefix = sys.argv[2]
+    # Optional: merge only this task (run by each task when it finishes)
+    task_ids = [int(sys.argv[3])] if len(sys.argv) > 3 else range(job_array_len)
+
+    merge_tasks(task_ids, out_traj_prefix)
@@ -1,22 +1,55 @@
 from ase.calculators.vasp import Vasp
 from ase.io import Trajectory
-from pymatgen.io.vasp.outputs import Vasprun
+from ase.io.ulm import InvalidULMFileError
+from vasp_convergence import check_convergence
+from work_ledger import WorkLedger
+from result_db import ResultDB
 
-import sys, os
+import sys, os, time
 
 traj_file = sys.argv[1]
 job_array_id = int(sys.argv[2])  # 0 to job_array_len - 1
 job_array_len = int(sys.argv[3])
 out_traj_prefix = sys.argv[4]
+batch_size = int(sys.argv[5]) if len(sys.argv) > 5 else 1  # images claimed at a time
+claim_timeout = 12 * 3600  # seconds before an unfinished claim (crashed task) can be taken over
+out_backend = 'traj'  # 'traj' (<prefix>_ef.traj / _unconv.traj per task), 'db' (ASE database) or 'both'
+db_name = os.path.join('..', out_traj_prefix + '.db')  # shared by all tasks; out_traj_prefix + '.db' for one db per task
+db_batch_size = 10  # rows written per database transaction
+pymatgen_fallback = False  # parse vasprun.xml with pymatgen's Vasprun if neither vasprun.xml nor OSZICAR can be streamed
 
 
 input_data = Trajectory(traj_file,'r')
-conv_traj = Trajectory(out_traj_prefix + '_ef.traj','w')
-unconv_traj = Trajectory(out_traj_prefix + '_unconv.traj','w')
+conv_traj_name = out_traj_prefix + '_ef.traj'
+unconv_traj_name = out_traj_prefix + '_unconv.traj'
 
-lower_image = round( len(input_data) / job_array_len * job_array_id )
-upper_image = round( len(input_data) / job_array_len * (job_array_id+1) )  # exclusive
+# Tasks pull images from a ledger shared by the whole array until none are left,
+# so a slow image only holds up the task that is computing it.
+# Finished images are recorded there too, so a relaunched array skips them.
+ledger = WorkLedger(os.path.join('..', out_traj_prefix + '_ledger'), len(input_data),
+                    job_array_id, claim_timeout=claim_timeout)
 
+# Results of a previous launch that reached the trajectories but not the ledger
+finished = {}
+for traj_name, state in ((conv_traj_name, 'converged'), (unconv_traj_name, 'unconverged')):
+    if os.path.isfile(traj_name) and os.path.getsize(traj_name) > 0:
+        try:
+            with Trajectory(traj_name, 'r') as traj:
+                for atoms in traj:
+                    if 'input_index' in atoms.info:
+                        finished[atoms.info['input_index']] = state
+        except InvalidULMFileError:
+            print(f"{traj_name} is not a valid ULM file. Ignoring its images.")
+if out_backend != 'traj':
+    result_db = ResultDB(db_name, batch_size=db_batch_size)
+    for index, converged in result_db.input_indices().items():
+        finished[index] = 'converged' if converged else 'unconverged'
+ledger.reconcile(finished)
+print(f"Ledger before this task: {dict(ledger.summary())}")
+
+if out_backend != 'db':
+    conv_traj = Trajectory(conv_traj_name, 'a')
+    unconv_traj = Trajectory(unconv_traj_name, 'a')
 
 calc = Vasp(prec = 'Medium',
             xc = 'PBE',
@@ -47,17 +80,40 @@ calc = Vasp(prec = 'Medium',
             #lmaxmix = 4
             )
 
-for k, atoms in enumerate(input_data[lower_image:upper_image]):
-    status_file_name = "." + str(lower_image) + "_" + str(k + lower_image) + "_" + str(upper_image)
-    with open(status_file_name, 'w') as f:
-        pass  # create an empty file
-    atoms.set_calculator(calc)
-    atoms.get_potential_energy(force_consistent=True)
-    if Vasprun("vasprun.xml").converged_electronic:
-        conv_traj.write(atoms)
-    else:
-        unconv_traj.write(atoms)
-    os.remove(status_file_name)
+done = {}  # images are marked finished in the ledger only once their results are written
+while True:
+    indices = ledger.claim(batch_size)
+    if not indices:
+        break
+    for k in indices:
+        atoms = input_data[k]
+        atoms.info['input_index'] = k
+        atoms.set_calculator(calc)
+        try:
+            start = time.perf_counter()
+            atoms.get_potential_energy(force_consistent=True)
+            wall_time = time.perf_counter() - start
+            convergence = check_convergence('.', fallback=pymatgen_fallback)
+            converged = convergence['converged_electronic']
+            n_scf = convergence['n_scf']
+        except Exception as e:
+            print(f"Image {k} failed: {e}")
+            ledger.finish(k, 'failed', error=str(e))
+            continue
+        if out_backend != 'db':
+            (conv_traj if converged else unconv_traj).write(atoms)
+        done[k] = 'converged' if converged else 'unconverged'
+        if out_backend == 'traj' or result_db.add(atoms, input_index=k, converged=converged, n_scf=n_scf,
+                                                  wall_time=wall_time, task=job_array_id):
+            for index, state in done.items():
+                ledger.finish(index, state)
+            done = {}
+if out_backend != 'traj':
+    result_db.flush()
+for index, state in done.items():
+    ledger.finish(index, state)
 input_data.close()
-conv_traj.close()
-unconv_traj.close()
+if out_backend != 'db':
+    conv_traj.close()
+    unconv_traj.close()
+print(f"Ledger after this task: {dict(ledger.summary())}")
@@ -0,0 +1,16 @@
+#!/bin/bash
+#SBATCH --job-name=ase_vasp_collect # Job name
+#SBATCH --nodes=1 # Run on 1 node
+#SBATCH --ntasks=1 # Merging only needs 1 CPU
+#SBATCH --partition=amd # SLURM partition (amd or intel)
+#SBATCH --output=slurm_collect_%j.log # Standard output and error log
+
+# Final merge of all task trajectories. Submitted by task 0 of run.sh as
+#   sbatch --dependency=afterany:<array job ID> collect.sh <array length> <out_traj_prefix>
+# so it also picks up tasks that were killed before they could merge their own results.
+
+pwd; hostname; date
+
+python ase_vasp_cleanup.py $1 $2
+
+date
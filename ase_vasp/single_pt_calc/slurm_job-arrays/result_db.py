@@ -0,0 +1,68 @@
+from ase.calculators.calculator import all_properties
+from ase.calculators.singlepoint import SinglePointCalculator
+from ase.db import connect
+import time
+
+
+class ResultDB:
+    """
+    Buffers finished images and writes them to an ASE database (SQLite) in
+    batches, one transaction per flush, so that many array tasks can share a
+    single database file without taking its lock for every image.
+
+    Each row stores the atoms and calculator results as usual, plus the
+    key-value pairs given to add(), e.g.
+        input_index (int): index of the image in the input trajectory
+        converged (bool): electronic convergence
+        n_scf (int): number of SCF iterations
+        wall_time (float): seconds spent in the calculation
+    which can then be queried directly, e.g. `ase db B.db converged=1,energy<-100`.
+
+    Args:
+        path (str): Database file. Use one file for the whole array, or one per
+            task (sharded) if the shared filesystem handles SQLite locks badly.
+        batch_size (int): Number of buffered rows that triggers a write.
+        max_wait (float): Seconds after which buffered rows are written even if
+            the batch is not full.
+    """
+    def __init__(self, path, batch_size=10, max_wait=3600):
+        self.path = path
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.db = connect(path)
+        self.pending = []
+        self.oldest = None
+
+    def add(self, atoms, **key_value_pairs):
+        """
+        Buffers a row with a copy of atoms and of its calculator results (the
+        calculator itself moves on to the next image). Returns True if the
+        buffer was written to the database.
+        """
+        snapshot = atoms.copy()
+        if atoms.calc is not None:
+            results = {key: value for key, value in atoms.calc.results.items() if key in all_properties}
+            snapshot.calc = SinglePointCalculator(snapshot, **results)
+            snapshot.calc.name = atoms.calc.name
+        self.pending.append((snapshot, key_value_pairs))
+        if self.oldest is None:
+            self.oldest = time.time()
+        if len(self.pending) >= self.batch_size or time.time() - self.oldest > self.max_wait:
+            self.flush()
+            return True
+        return False
+
+    def flush(self):
+        """Writes all buffered rows in one transaction."""
+        if not self.pending:
+            return
+        with self.db:
+            for atoms, key_value_pairs in self.pending:
+                self.db.write(atoms, **key_value_pairs)
+        self.pending = []
+        self.oldest = None
+
+    def input_indices(self):
+        """Returns {input_index: converged} for every row already in the database."""
+        return {row.input_index: bool(row.converged)
+                for row in self.db.select('input_index', include_data=False)}
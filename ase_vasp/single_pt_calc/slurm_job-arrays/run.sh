@@ -28,34 +28,24 @@ out_traj_prefix="B"
 
 echo "Index $SLURM_ARRAY_TASK_ID of $SLURM_ARRAY_TASK_MAX in job $SLURM_ARRAY_JOB_ID"
 
-if [[ -d $SLURM_ARRAY_TASK_ID ]]; then
-    echo "Directory $SLURM_ARRAY_TASK_ID already exists."
-    exit 1
+# task 0 queues the final merge, which starts once every task of the array has ended
+if [[ $SLURM_ARRAY_TASK_ID == 0 ]]; then
+    sbatch --dependency=afterany:$SLURM_ARRAY_JOB_ID collect.sh $SLURM_ARRAY_TASK_COUNT $out_traj_prefix
 fi
 
-mkdir $SLURM_ARRAY_TASK_ID
+# an existing directory means this is a relaunch: its results are kept and finished images are skipped
+mkdir -p $SLURM_ARRAY_TASK_ID
 cd $SLURM_ARRAY_TASK_ID
 
 export ASE_VASP_COMMAND="mpirun -np $SLURM_NTASKS vasp_std"
 export VASP_PP_PATH="/home/graeme/vasp/"
 
 
-cp ../ase_vasp_run.py .
+cp ../ase_vasp_run.py ../work_ledger.py ../result_db.py .
+cp ../../../vasp_convergence.py .
 python ase_vasp_run.py $traj_path $SLURM_ARRAY_TASK_ID $SLURM_ARRAY_TASK_COUNT $out_traj_prefix
 
 
-if [[ $SLURM_ARRAY_TASK_ID == 0 ]]; then
-    cd ..
-
-    # wait for others in the array to finish
-    while true; do
-        if [[ $( squeue -j $SLURM_ARRAY_JOB_ID | wc -l ) == 2 ]]; then
-            break
-        fi
-        echo "Waiting for others..."
-        sleep 10
-    done
-
-    # collect all array traj files
-    python ase_vasp_cleanup.py $SLURM_ARRAY_TASK_COUNT $out_traj_prefix
-fi
+# append this task's results to the combined trajectories right away
+cd ..
+python ase_vasp_cleanup.py $SLURM_ARRAY_TASK_COUNT $out_traj_prefix $SLURM_ARRAY_TASK_ID
@@ -0,0 +1,123 @@
+import fcntl
+import json
+import os
+import time
+from collections import Counter
+
+FINISHED_STATES = ('converged', 'unconverged', 'failed')
+
+
+class WorkLedger:
+    """
+    Shared record of which images of an input trajectory have been claimed by
+    which array task, kept as one small JSON file per image in a directory on
+    the shared filesystem. Claims are made while holding an exclusive lock on
+    <path>/ledger.lock, so two tasks never claim the same image.
+
+    Each record has a state: 'claimed' (in progress), or one of
+    FINISHED_STATES ('converged', 'unconverged', 'failed'). Finished images are
+    never claimed again, so relaunching the array only computes what is missing.
+    To retry an image, delete its record (it is picked up by the next launch).
+
+    <path>/cursor holds the lowest image that is not finished yet, so a claim
+    starts there instead of scanning the whole trajectory. It is only trusted
+    within one launch: the first claim of a new launch scans from image 0.
+
+    Args:
+        path (str): Ledger directory (shared by all tasks of the array).
+        n_images (int): Number of images in the input trajectory.
+        task_id (int): Array task ID of this process.
+        claim_timeout (float): Seconds after which a claim that never finished
+            (e.g. its task crashed or was preempted) can be claimed again.
+        run_id (str, optional): ID of this launch of the array (default:
+            SLURM_ARRAY_JOB_ID). Unfinished claims of an earlier launch can be
+            claimed again right away.
+    """
+    def __init__(self, path, n_images, task_id, claim_timeout=12 * 3600, run_id=None):
+        self.path = path
+        self.n_images = n_images
+        self.task_id = task_id
+        self.claim_timeout = claim_timeout
+        self.run_id = os.environ.get('SLURM_ARRAY_JOB_ID', '') if run_id is None else str(run_id)
+        os.makedirs(path, exist_ok=True)
+
+    def _record_path(self, index):
+        return os.path.join(self.path, str(index))
+
+    def read(self, index):
+        """Returns the record of an image ({'state': ..., 'task': ..., 'time': ...}) or None."""
+        try:
+            with open(self._record_path(index)) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def _write(self, index, state, **extra):
+        record = {'state': state, 'task': self.task_id, 'run': self.run_id, 'time': time.time(), **extra}
+        tmp = self._record_path(index) + f'.tmp{self.task_id}'
+        with open(tmp, 'w') as f:
+            json.dump(record, f)
+        os.replace(tmp, self._record_path(index))  # atomic
+
+    def _claimable(self, record, now):
+        if record is None:
+            return True
+        if record['state'] != 'claimed':
+            return False
+        return record.get('run') != self.run_id or now - record['time'] > self.claim_timeout
+
+    def _read_cursor(self):
+        """Lowest image that may not be finished (0 if the cursor is from another launch)."""
+        try:
+            with open(os.path.join(self.path, 'cursor')) as f:
+                cursor = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return 0
+        return cursor['index'] if cursor.get('run') == self.run_id else 0
+
+    def _write_cursor(self, index):
+        tmp = os.path.join(self.path, f'cursor.tmp{self.task_id}')
+        with open(tmp, 'w') as f:
+            json.dump({'index': index, 'run': self.run_id}, f)
+        os.replace(tmp, os.path.join(self.path, 'cursor'))
+
+    def claim(self, batch_size=1):
+        """Claims up to batch_size unprocessed images. Returns their indices ([] when all are taken)."""
+        with open(os.path.join(self.path, 'ledger.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            now = time.time()
+            start = cursor = self._read_cursor()
+            claimed = []
+            for index in range(start, self.n_images):
+                record = self.read(index)
+                if index == cursor and record is not None and record['state'] in FINISHED_STATES:
+                    cursor += 1  # all images below are finished
+                elif self._claimable(record, now):
+                    self._write(index, 'claimed')
+                    claimed.append(index)
+                    if len(claimed) == batch_size:
+                        break
+            if cursor != start or start == 0:
+                self._write_cursor(cursor)
+            return claimed  # lock is released when the file is closed
+
+    def finish(self, index, state, **extra):
+        """Marks a claimed image as processed. state is one of FINISHED_STATES."""
+        self._write(index, state, **extra)
+
+    def reconcile(self, states):
+        """
+        Marks images as finished ({index: state}) unless the ledger already
+        says so, e.g. for results that reached an output trajectory just
+        before the task was killed.
+        """
+        with open(os.path.join(self.path, 'ledger.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            for index, state in states.items():
+                record = self.read(index)
+                if record is None or record['state'] not in FINISHED_STATES:
+                    self._write(index, state)
+
+    def summary(self):
+        """Returns the number of images in each state ('missing' if there is no record)."""
+        return Counter((self.read(index) or {'state': 'missing'})['state'] for index in range(self.n_images))
@@ -0,0 +1,136 @@
+import os
+import sys
+import types
+
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))  # ase_vasp/
+from vasp_convergence import check_convergence, check_oszicar, check_vasprun, ionic_energies
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'vasp_convergence')
+
+
+def data(*parts):
+    return os.path.join(DATA, *parts)
+
+
+def test_vasprun_complete():
+    result = check_vasprun(data('complete', 'vasprun.xml'))
+    assert result == {'converged_electronic': True, 'converged_ionic': True, 'n_scf': 4, 'n_ionic': 2,
+                      'nelm': 60, 'nsw': 3, 'complete': True, 'source': 'vasprun'}
+
+
+def test_vasprun_truncated_mid_calculation():
+    result = check_vasprun(data('truncated', 'vasprun.xml'))
+    assert not result['complete']
+    assert result['n_ionic'] == 1  # only the ionic steps written completely
+    assert (result['nelm'], result['nsw']) == (60, 3)
+    assert not result['converged_electronic'] and not result['converged_ionic']
+
+
+def test_vasprun_hit_nelm():
+    result = check_vasprun(data('nelm', 'vasprun.xml'))
+    assert result['complete']
+    assert (result['n_scf'], result['nelm']) == (5, 5)
+    assert not result['converged_electronic']
+    assert result['converged_ionic']  # single point (NSW = 0)
+
+
+def test_oszicar_matches_vasprun():
+    for case in ('complete', 'nelm'):
+        vasprun = check_vasprun(data(case, 'vasprun.xml'))
+        oszicar = check_oszicar(data(case, 'OSZICAR'), vasprun['nelm'], vasprun['nsw'])
+        for key in ('converged_electronic', 'converged_ionic', 'n_scf', 'n_ionic', 'complete'):
+            assert oszicar[key] == vasprun[key], (case, key)
+
+
+def test_oszicar_ionic_step_in_progress():
+    result = check_oszicar(data('truncated_oszicar', 'OSZICAR'), nelm=60, nsw=3)
+    assert result['n_ionic'] == 1
+    assert not result['complete']
+    assert not result['converged_electronic']
+
+
+def test_ionic_energies():
+    assert ionic_energies(data('oszicar_only', 'OSZICAR')) == pytest.approx([-10.0, -10.2, -10.4])
+
+
+def test_ionic_energies_step_in_progress():
+    # only the ionic step that has its F= line, not the one still in its SCF loop
+    assert ionic_energies(data('truncated_oszicar', 'OSZICAR')) == pytest.approx([-10.0])
+
+
+def test_ionic_energies_missing_oszicar(tmp_path):
+    assert ionic_energies(str(tmp_path / 'OSZICAR')) == []
+
+
+@pytest.mark.parametrize('fallback', [False, True])
+def test_check_convergence_complete(fallback):
+    result = check_convergence(data('complete'), fallback=fallback)
+    assert result['source'] == 'vasprun'
+    assert result['converged_electronic'] and result['converged_ionic']
+
+
+@pytest.mark.parametrize('fallback', [False, True])
+def test_check_convergence_hit_nelm(fallback):
+    result = check_convergence(data('nelm'), fallback=fallback)
+    assert result['source'] == 'vasprun'
+    assert not result['converged_electronic']
+
+
+@pytest.mark.parametrize('fallback', [False, True])
+def test_check_convergence_truncated_vasprun_with_oszicar(fallback):
+    # NELM/NSW come from the truncated vasprun.xml; VASP did not exit normally
+    result = check_convergence(data('truncated_oszicar'), fallback=fallback)
+    assert result['source'] == 'oszicar'
+    assert (result['nelm'], result['nsw'], result['n_ionic']) == (60, 3, 1)
+    assert not result['complete']
+    assert not result['converged_electronic'] and not result['converged_ionic']
+
+
+@pytest.mark.parametrize('fallback', [False, True])
+def test_check_convergence_oszicar_only(fallback):
+    result = check_convergence(data('oszicar_only'), fallback=fallback)
+    assert result == {'converged_electronic': True, 'converged_ionic': False, 'n_scf': 3, 'n_ionic': 3,
+                      'nelm': 40, 'nsw': 3, 'complete': True, 'source': 'oszicar'}
+
+
+def test_check_convergence_truncated_without_oszicar():
+    result = check_convergence(data('truncated'))
+    assert result['source'] == 'vasprun'
+    assert not result['complete']
+    assert not result['converged_electronic'] and not result['converged_ionic']
+
+
+def test_check_convergence_no_output(tmp_path):
+    result = check_convergence(str(tmp_path))
+    assert result['source'] == 'none'
+    assert not result['converged_electronic'] and not result['converged_ionic']
+
+
+def test_check_convergence_fallback_uses_pymatgen(monkeypatch):
+    """Only a run that neither vasprun.xml nor OSZICAR can answer for goes to pymatgen."""
+    opened = []
+
+    class Vasprun:
+        def __init__(self, path, **kwargs):
+            opened.append(path)
+            self.converged_electronic = True
+            self.converged_ionic = False
+            self.ionic_steps = [{'electronic_steps': [{}] * 7}, {'electronic_steps': [{}] * 2}]
+            self.parameters = {'NELM': 60, 'NSW': 2}
+
+    module = types.ModuleType('pymatgen.io.vasp.outputs')
+    module.Vasprun = Vasprun
+    for name in ('pymatgen', 'pymatgen.io', 'pymatgen.io.vasp'):
+        monkeypatch.setitem(sys.modules, name, types.ModuleType(name))
+    monkeypatch.setitem(sys.modules, 'pymatgen.io.vasp.outputs', module)
+
+    for case in ('complete', 'nelm', 'truncated_oszicar', 'oszicar_only'):
+        check_convergence(data(case), fallback=True)
+    assert opened == []
+
+    result = check_convergence(data('truncated'), fallback=True)
+    assert opened == [data('truncated', 'vasprun.xml')]
+    assert result == {'converged_electronic': True, 'converged_ionic': False, 'n_scf': 2, 'n_ionic': 2,
+                      'nelm': 60, 'nsw': 2, 'complete': True, 'source': 'pymatgen'}
@@ -0,0 +1,179 @@
+"""
+Cheap convergence checks of a finished (or killed) VASP run.
+
+pymatgen's Vasprun parses every eigenvalue and DOS block of vasprun.xml just to
+answer whether the last SCF cycle stopped before NELM. check_convergence()
+streams vasprun.xml instead, keeping only NELM/NSW and the number of SCF steps
+of each ionic step, and falls back to OSZICAR (+ INCAR for NELM/NSW) when
+vasprun.xml is missing or truncated. The criteria are the
+same as Vasprun.converged_electronic / converged_ionic:
+    electronic: SCF steps of the last ionic step < NELM
+    ionic: NSW <= 1 or number of ionic steps < NSW
+
+Used by single_pt_calc/slurm_job-arrays/ase_vasp_run.py (run.sh copies this
+file into each task directory) and ga_opt/Mg/Mg-$i/calc.py (which adds this
+directory to sys.path).
+"""
+import os
+import re
+import xml.etree.ElementTree as ET
+
+NELM_DEFAULT = 60
+NSW_DEFAULT = 0
+
+
+def _result(n_scf, nelm, nsw, complete, source):
+    n_ionic = len(n_scf)
+    return {'converged_electronic': complete and n_ionic > 0 and n_scf[-1] < nelm,
+            'converged_ionic': complete and n_ionic > 0 and (nsw <= 1 or n_ionic < nsw),
+            'n_scf': n_scf[-1] if n_scf else 0,
+            'n_ionic': n_ionic,
+            'nelm': nelm,
+            'nsw': nsw,
+            'complete': complete,
+            'source': source}
+
+
+def check_vasprun(path):
+    """
+    Streams vasprun.xml and returns the convergence dict (see check_convergence).
+    A truncated file (VASP still running or killed) gives complete=False and
+    counts the ionic steps that were written completely.
+    """
+    nelm, nsw = NELM_DEFAULT, NSW_DEFAULT
+    n_scf = []  # SCF steps of each completed ionic step
+    n_scstep = 0
+    complete = False
+    depth = 0
+    try:
+        for event, elem in ET.iterparse(path, events=('start', 'end')):
+            if event == 'start':
+                depth += 1
+                continue
+            depth -= 1
+            if elem.tag == 'i' and elem.get('name') in ('NELM', 'NSW') and elem.text:
+                if elem.get('name') == 'NELM':
+                    nelm = int(elem.text)
+                else:
+                    nsw = int(elem.text)
+            elif elem.tag == 'scstep':
+                n_scstep += 1
+                elem.clear()
+            elif elem.tag == 'calculation':
+                n_scf.append(n_scstep)
+                n_scstep = 0
+                elem.clear()
+            elif elem.tag in ('eigenvalues', 'projected', 'dos', 'dynmat', 'partial'):
+                elem.clear()  # the large blocks
+            elif elem.tag == 'modeling' and depth == 0:
+                complete = True
+    except ET.ParseError:
+        pass
+    return _result(n_scf, nelm, nsw, complete, 'vasprun')
+
+
+def read_incar_int(incar_path, tag, default):
+    """Returns the integer value of tag in an INCAR file, or default."""
+    try:
+        with open(incar_path) as f:
+            for line in f:
+                for statement in line.split('#')[0].split('!')[0].split(';'):
+                    key, _, value = statement.partition('=')
+                    if key.strip().upper() == tag and value.split():
+                        return int(float(value.split()[0]))
+    except FileNotFoundError:
+        pass
+    return default
+
+
+_OSZICAR_SCF = re.compile(r'^\s*[A-Z][A-Za-z ]{1,3}:\s+\d+')
+_OSZICAR_IONIC = re.compile(r'^\s*\d+\s+[FT]=')  # relaxation or MD
+
+
+def oszicar_scf_steps(path):
+    """
+    Counts the SCF lines (DAV:, RMM:, CG :, ...) before each ionic summary line
+    ("  1 F= ...") of an OSZICAR. Returns the counts of the finished ionic steps
+    and the count of the ionic step in progress.
+    """
+    n_scf = []
+    n_scstep = 0
+    with open(path, errors='replace') as f:
+        for line in f:
+            if _OSZICAR_IONIC.match(line):
+                n_scf.append(n_scstep)
+                n_scstep = 0
+            elif _OSZICAR_SCF.match(line):
+                n_scstep += 1
+    return n_scf, n_scstep
+
+
+def check_oszicar(path, nelm=NELM_DEFAULT, nsw=NSW_DEFAULT):
+    """
+    Returns the convergence dict from the SCF steps of an OSZICAR (see
+    oszicar_scf_steps). OSZICAR does not say whether VASP exited normally, so
+    complete means that the last ionic step was written completely.
+    """
+    n_scf, n_scstep = oszicar_scf_steps(path)
+    complete = len(n_scf) > 0 and n_scstep == 0
+    return _result(n_scf, nelm, nsw, complete, 'oszicar')
+
+
+def ionic_energies(path):
+    """Returns the free energies (F=, eV) of the ionic steps written to an OSZICAR so far."""
+    energies = []
+    try:
+        with open(path, errors='replace') as f:
+            for line in f:
+                if _OSZICAR_IONIC.match(line):
+                    try:
+                        energies.append(float(line.split('F=')[1].split()[0]))
+                    except (IndexError, ValueError):
+                        pass  # line still being written
+    except FileNotFoundError:
+        pass
+    return energies
+
+
+def check_convergence(vasp_dir='.', fallback=False):
+    """
+    Returns a dict with
+        converged_electronic (bool), converged_ionic (bool),
+        n_scf (int): SCF steps of the last ionic step
+        n_ionic (int): number of ionic steps
+        nelm, nsw (int): limits the run was made with
+        complete (bool): whether the output was fully written
+        source (str): 'vasprun', 'oszicar' or 'pymatgen'
+    from vasprun.xml if it was written completely, otherwise from OSZICAR.
+    With fallback=True, pymatgen's Vasprun is used when neither can be read,
+    and it raises like Vasprun does. Otherwise a run without readable output
+    is reported as not converged.
+    """
+    vasprun_path = os.path.join(vasp_dir, 'vasprun.xml')
+    oszicar_path = os.path.join(vasp_dir, 'OSZICAR')
+    result = None
+    if os.path.isfile(vasprun_path):
+        result = check_vasprun(vasprun_path)
+        if result['complete']:
+            return result
+    if os.path.isfile(oszicar_path):
+        incar_path = os.path.join(vasp_dir, 'INCAR')
+        nelm = result['nelm'] if result else read_incar_int(incar_path, 'NELM', NELM_DEFAULT)
+        nsw = result['nsw'] if result else read_incar_int(incar_path, 'NSW', NSW_DEFAULT)
+        oszicar_result = check_oszicar(oszicar_path, nelm, nsw)
+        if oszicar_result['n_ionic'] > 0:
+            if result is not None:  # truncated vasprun.xml: VASP did not exit normally
+                oszicar_result.update(converged_electronic=False, converged_ionic=False, complete=False)
+            return oszicar_result
+    if fallback:
+        from pymatgen.io.vasp.outputs import Vasprun
+        vasprun = Vasprun(vasprun_path, parse_dos=False, parse_eigen=False, parse_projected_eigen=False)
+        return {'converged_electronic': vasprun.converged_electronic,
+                'converged_ionic': vasprun.converged_ionic,
+                'n_scf': len(vasprun.ionic_steps[-1]['electronic_steps']),
+                'n_ionic': len(vasprun.ionic_steps),
+                'nelm': vasprun.parameters['NELM'],
+                'nsw': vasprun.parameters.get('NSW', 0),
+                'complete': True,
+                'source': 'pymatgen'}
+    return result if result is not None else _result([], NELM_DEFAULT, NSW_DEFAULT, False, 'none')
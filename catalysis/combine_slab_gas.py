@@ -1,9 +1,11 @@
 import numpy as np
-from ase.io import read, write
+from ase.io import read, write, Trajectory
+from ase.db import connect
 from ase.md.velocitydistribution import MaxwellBoltzmannDistribution, Stationary, ZeroRotation
 from ase.units import kB, Ang, fs
 from ase import Atoms
 import warnings
+import itertools
 from collections import Counter
 
 #================================================================
@@ -56,6 +58,116 @@ def sample_rotational_velocity(atoms, temperature_K):
     # Convert back to Cartesian coordinates
     return omega @ basis
 
+
+def initialize_gas_velocities(
+    gas,
+    gas_vibration_temp=3000.0,
+    gas_rotation_temp=300.0,
+    gas_translational_temp=300.0,
+    verbose=True,
+):
+    """
+    Randomly rotates a gas molecule in place and sets its velocities for an
+    NVE bombardment simulation.
+
+    - Gas atoms get vibrational, rotational, and translational velocities drawn
+        from the Maxwell-Boltzmann distribution at gas_..._temp.
+    - Gas center-of-mass velocity in z is drawn from a Maxwell-Flux distribution
+      at gas_translational_temp (toward -z) and added to the internal velocities.
+
+    Args:
+        gas (ase.Atoms): Atoms object representing the molecule. Modified in place.
+        gas_..._temp (float): Temperatures in Kelvin.
+        verbose (bool): Print each step.
+    """
+    log = print if verbose else (lambda *args, **kwargs: None)
+
+    total_gas_mass = np.sum(gas.get_masses())  # amu
+    if len(gas) == 1:
+        warnings.warn("Gas molecule has only one atom.")
+        MaxwellBoltzmannDistribution(gas, temperature_K=gas_translational_temp)
+        log(f"Initialized gas translational velocities to {gas_translational_temp} K.")
+    else:
+        # Apply a random rotation to the gas molecule
+        gas.rotate(np.random.rand() * 360, 'x', rotate_cell=False)
+        gas.rotate(np.random.rand() * 360, 'y', rotate_cell=False)
+        gas.rotate(np.random.rand() * 360, 'z', rotate_cell=False)
+        log("Applied random rotation to the gas molecule.")
+
+        # Set gas vibrational velocities at vibrational temperature
+        MaxwellBoltzmannDistribution(gas, temperature_K=gas_vibration_temp)
+        log(f"Initialized gas vibrational velocities to {gas_vibration_temp} K.")
+
+        # Zero center-of-mass (COM) linear and angular momenta for gas
+        Stationary(gas, preserve_temperature=False)
+        ZeroRotation(gas, preserve_temperature=False)
+        log("Zeroed gas center-of-mass momenta.")
+
+        # Set gas rotational velocities
+        omega = sample_rotational_velocity(gas, temperature_K=gas_rotation_temp)
+        pos_offset = gas.get_positions() - gas.get_center_of_mass()
+        gas.set_velocities(gas.get_velocities() + np.cross(omega, pos_offset))
+        log(f"Set gas rotational velocities at {gas_rotation_temp} K.")
+
+        # Set gas translational velocities
+        mb_std = np.sqrt(kB * gas_translational_temp / total_gas_mass)  # sqrt(eV/amu)
+        gas.set_velocities(gas.get_velocities() + np.random.normal(0, mb_std, 3))
+        log(f"Set gas translational velocities at {gas_translational_temp} K.")
+
+    # --- Set Gas Center-of-Mass (COM) Velocity from Maxwell-Flux ---
+    # Draw from Maxwell-Flux distribution
+    kBT_over_m = kB * gas_translational_temp / total_gas_mass  # eV/amu (unit of v**2)
+    com_vz_target = mf_inverse_cdf( np.random.rand(), kBT_over_m )  # unit of (eV/amu)**0.5
+    com_vz_target *= -1  # negative z direction to collide with slab
+    log(f"Target COM velocity in z (Maxwell-Flux at {gas_translational_temp} K): {com_vz_target.round(3)} (eV/amu)**0.5")
+
+    # --- Adjust Atomic Velocities in z to Match Target COM Velocity ---
+    # Get the current COM velocity from the internal thermal motion
+    gas_momenta = gas.get_momenta()
+    com_vz_current = (np.sum(gas_momenta, axis=0) / total_gas_mass)[2]
+    
+    # Calculate the z velocity correction needed per atom
+    velocity_correction = com_vz_target - com_vz_current
+    
+    # Add this correction to each atom in the gas molecule
+    current_velocities = gas.get_velocities()
+    current_velocities[:, 2] += velocity_correction
+    gas.set_velocities(current_velocities)
+    log("Adjusted atomic velocities to match target COM velocity.")
+
+
+def random_rotation_matrices(u):
+    """
+    Maps uniform random numbers onto rotation matrices distributed uniformly
+    over SO(3) (Shoemake's unit quaternion method).
+
+    Args:
+        u (array): Uniform random numbers in [0, 1) of shape (N, 3).
+
+    Returns:
+        numpy.ndarray: Rotation matrices of shape (N, 3, 3). Apply to row
+            vectors as positions @ R.T.
+    """
+    u = np.atleast_2d(u)
+    a = np.sqrt(1 - u[:, 0])
+    b = np.sqrt(u[:, 0])
+    x = a * np.sin(2 * np.pi * u[:, 1])
+    y = a * np.cos(2 * np.pi * u[:, 1])
+    z = b * np.sin(2 * np.pi * u[:, 2])
+    w = b * np.cos(2 * np.pi * u[:, 2])
+
+    R = np.empty((len(u), 3, 3))
+    R[:, 0, 0] = 1 - 2 * (y**2 + z**2)
+    R[:, 0, 1] = 2 * (x * y - z * w)
+    R[:, 0, 2] = 2 * (x * z + y * w)
+    R[:, 1, 0] = 2 * (x * y + z * w)
+    R[:, 1, 1] = 1 - 2 * (x**2 + z**2)
+    R[:, 1, 2] = 2 * (y * z - x * w)
+    R[:, 2, 0] = 2 * (x * z - y * w)
+    R[:, 2, 1] = 2 * (y * z + x * w)
+    R[:, 2, 2] = 1 - 2 * (x**2 + y**2)
+    return R
+
 #================================================================
 ### Other helper functions
 
@@ -82,6 +194,64 @@ def check_poscar_element_groups(filename):
             print(f"***SAME ELEMENT FOUND IN MULTIPLE GROUPS IN {filename}***\n"
                    "Manual postprocessing is required to separate them again.")
             print()
+
+
+class PeriodicCellList:
+    """
+    Bins points of a (periodic) cell into sub-cells that are at least `cutoff`
+    wide, so checking whether anything lies within `cutoff` of a point only looks
+    at the 27 surrounding bins instead of every stored point.
+
+    Args:
+        cell (array): 3x3 cell matrix (rows are lattice vectors).
+        pbc (array of bool): Periodicity along each lattice vector.
+        cutoff (float): Distance (Angstrom) used by any_within().
+    """
+    def __init__(self, cell, pbc, cutoff):
+        self.cell = np.asarray(cell, dtype=float)
+        self.inv_cell = np.linalg.inv(self.cell)
+        self.pbc = np.asarray(pbc, dtype=bool) & np.ones(3, dtype=bool)
+        self.cutoff = cutoff
+
+        # Perpendicular width of the cell along each lattice vector
+        volume = abs(np.linalg.det(self.cell))
+        widths = volume / np.linalg.norm(np.cross(self.cell[[1, 2, 0]], self.cell[[2, 0, 1]]), axis=1)
+        if np.any(2 * cutoff > widths[self.pbc]):
+            raise ValueError(f"cutoff {cutoff} is larger than half the cell width {widths.min():.3f}.")
+        self.n_bins = np.maximum(np.floor(widths / cutoff).astype(int), 1)
+        self.shifts = np.array(list(itertools.product((-1, 0, 1), repeat=3)))
+        self.bins = {}  # bin index -> list of positions
+
+    def _bin_indices(self, positions):
+        frac = positions @ self.inv_cell
+        frac[:, self.pbc] %= 1.0
+        idx = np.floor(frac * self.n_bins).astype(int)
+        return np.clip(idx, 0, self.n_bins - 1)
+
+    def add(self, positions):
+        """Stores positions (array of shape (N, 3))."""
+        positions = np.atleast_2d(positions)
+        for key, pos in zip(map(tuple, self._bin_indices(positions)), positions):
+            self.bins.setdefault(key, []).append(pos)
+
+    def _neighbors(self, position):
+        keys = self._bin_indices(position[np.newaxis])[0] + self.shifts
+        keys[:, self.pbc] %= self.n_bins[self.pbc]
+        inside = np.all((keys >= 0) & (keys < self.n_bins), axis=1)
+        near = [p for key in set(map(tuple, keys[inside])) for p in self.bins.get(key, ())]
+        return np.array(near).reshape(-1, 3)
+
+    def any_within(self, positions):
+        """True if any stored point is closer than cutoff to any of positions (minimum image)."""
+        for pos in np.atleast_2d(positions):
+            near = self._neighbors(pos)
+            if len(near) == 0:
+                continue
+            d_frac = (near - pos) @ self.inv_cell
+            d_frac[:, self.pbc] -= np.round(d_frac[:, self.pbc])
+            if np.any(np.linalg.norm(d_frac @ self.cell, axis=1) < self.cutoff):
+                return True
+        return False
 #================================================================
 
 
@@ -118,60 +288,11 @@ def combine_slab_and_gas_with_velocities(
     MaxwellBoltzmannDistribution(slab, temperature_K=slab_temp)
     print(f"Initialized slab velocities to {slab_temp} K.")
 
-    # --- 2. Initialize Gas Velocities and Orientation ---
-    total_gas_mass = np.sum(gas.get_masses())  # amu
-    if len(gas) == 1:
-        warnings.warn("Gas molecule has only one atom.")
-        MaxwellBoltzmannDistribution(gas, temperature_K=gas_translational_temp)
-        print(f"Initialized gas translational velocities to {gas_translational_temp} K.")
-    else:
-        # Apply a random rotation to the gas molecule
-        gas.rotate(np.random.rand() * 360, 'x', rotate_cell=False)
-        gas.rotate(np.random.rand() * 360, 'y', rotate_cell=False)
-        gas.rotate(np.random.rand() * 360, 'z', rotate_cell=False)
-        print("Applied random rotation to the gas molecule.")
-
-        # Set gas vibrational velocities at vibrational temperature
-        MaxwellBoltzmannDistribution(gas, temperature_K=gas_vibration_temp)
-        print(f"Initialized gas vibrational velocities to {gas_vibration_temp} K.")
-
-        # Zero center-of-mass (COM) linear and angular momenta for gas
-        Stationary(gas, preserve_temperature=False)
-        ZeroRotation(gas, preserve_temperature=False)
-        print("Zeroed gas center-of-mass momenta.")
-
-        # Set gas rotational velocities
-        omega = sample_rotational_velocity(gas, temperature_K=gas_rotation_temp)
-        pos_offset = gas.get_positions() - gas.get_center_of_mass()
-        gas.set_velocities(gas.get_velocities() + np.cross(omega, pos_offset))
-        print(f"Set gas rotational velocities at {gas_rotation_temp} K.")
-
-        # Set gas translational velocities
-        mb_std = np.sqrt(kB * gas_translational_temp / total_gas_mass)  # sqrt(eV/amu)
-        gas.set_velocities(gas.get_velocities() + np.random.normal(0, mb_std, 3))
-        print(f"Set gas translational velocities at {gas_translational_temp} K.")
-
-
-    # --- 3. Set Gas Center-of-Mass (COM) Velocity from Maxwell-Flux ---
-    # Draw from Maxwell-Flux distribution
-    kBT_over_m = kB * gas_translational_temp / total_gas_mass  # eV/amu (unit of v**2)
-    com_vz_target = mf_inverse_cdf( np.random.rand(), kBT_over_m )  # unit of (eV/amu)**0.5
-    com_vz_target *= -1  # negative z direction to collide with slab
-    print(f"Target COM velocity in z (Maxwell-Flux at {gas_translational_temp} K): {com_vz_target.round(3)} (eV/amu)**0.5")
-
-    # --- 4. Adjust Atomic Velocities in z to Match Target COM Velocity ---
-    # Get the current COM velocity from the internal thermal motion
-    gas_momenta = gas.get_momenta()
-    com_vz_current = (np.sum(gas_momenta, axis=0) / total_gas_mass)[2]
-    
-    # Calculate the z velocity correction needed per atom
-    velocity_correction = com_vz_target - com_vz_current
-    
-    # Add this correction to each atom in the gas molecule
-    current_velocities = gas.get_velocities()
-    current_velocities[:, 2] += velocity_correction
-    gas.set_velocities(current_velocities)
-    print("Adjusted atomic velocities to match target COM velocity.")
+    # --- 2.-4. Initialize Gas Orientation and Velocities ---
+    initialize_gas_velocities(gas,
+                              gas_vibration_temp=gas_vibration_temp,
+                              gas_rotation_temp=gas_rotation_temp,
+                              gas_translational_temp=gas_translational_temp)
 
     # --- 5. Position the Gas Molecule Above the Slab ---
     max_z_slab = slab.get_positions()[:, 2].max()
@@ -199,5 +320,474 @@ def combine_slab_and_gas_with_velocities(
     check_poscar_element_groups(slab_file)
 
 
+#================================================================
+### Ensemble (many initial conditions at once)
+
+def draw_ensemble_variates(n_samples, n_slab, n_gas, seed=None):
+    """
+    Draws all random numbers needed for n_samples slab+gas initial conditions.
+
+    Every sample gets its own child of np.random.SeedSequence(seed), so
+    sample i is the same no matter how many samples are drawn in total.
+
+    Args:
+        n_samples (int): Number of initial conditions.
+        n_slab (int): Number of slab atoms.
+        n_gas (int): Number of gas atoms.
+        seed (int, optional): Master seed. A fresh one is drawn if None.
+
+    Returns:
+        dict: Arrays with a leading axis of length n_samples.
+            Uniforms in [0, 1): 'rotation' (N, 3), 'impact' (N, 2), 'flux' (N,).
+            Standard normals: 'slab' (N, n_slab, 3), 'vibration' (N, n_gas, 3),
+            'spin' (N, 3), 'translation' (N, 3).
+            Also the master 'seed' (int).
+    """
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+    children = np.random.SeedSequence(seed).spawn(n_samples)
+
+    n_uniform = 3 + 2 + 1
+    n_normal = 3 * n_slab + 3 * n_gas + 3 + 3
+    uniforms = np.empty((n_samples, n_uniform))
+    normals = np.empty((n_samples, n_normal))
+    for i, child in enumerate(children):
+        rng = np.random.default_rng(child)
+        uniforms[i] = rng.random(n_uniform)
+        normals[i] = rng.standard_normal(n_normal)
+
+    i_vib = 3 * n_slab
+    i_spin = i_vib + 3 * n_gas
+    return {
+        'seed': seed,
+        'rotation': uniforms[:, 0:3],
+        'impact': uniforms[:, 3:5],
+        'flux': uniforms[:, 5],
+        'slab': normals[:, :i_vib].reshape(n_samples, n_slab, 3),
+        'vibration': normals[:, i_vib:i_spin].reshape(n_samples, n_gas, 3),
+        'spin': normals[:, i_spin:i_spin + 3],
+        'translation': normals[:, i_spin + 3:i_spin + 6],
+    }
+
+
+def ensemble_gas_states(gas, variates, gas_vibration_temp=3000.0,
+                        gas_rotation_temp=300.0, gas_translational_temp=300.0):
+    """
+    Vectorized version of the gas set up in combine_slab_and_gas_with_velocities.
+
+    Internal (vibrational + rotational) velocities are built in the frame of the
+    unrotated molecule and rotated together with the positions, which gives the
+    same distribution as rotating first since Maxwell-Boltzmann is isotropic.
+
+    Args:
+        gas (ase.Atoms): The gas molecule.
+        variates (dict): Output of draw_ensemble_variates (or any dict with the
+            same keys and shapes).
+        gas_..._temp (float): Temperatures in Kelvin.
+
+    Returns:
+        tuple: (positions, velocities), each of shape (N, n_gas, 3). Positions
+            are relative to the gas center of mass.
+    """
+    masses = gas.get_masses()
+    total_gas_mass = np.sum(masses)  # amu
+    offset = gas.get_positions() - gas.get_center_of_mass()
+    n_samples = len(variates['flux'])
+
+    if len(gas) == 1:
+        warnings.warn("Gas molecule has only one atom.")
+        positions = np.zeros((n_samples, 1, 3))
+        mb_std = np.sqrt(kB * gas_translational_temp / total_gas_mass)
+        velocities = variates['translation'][:, np.newaxis, :] * mb_std
+    else:
+        # Vibrational velocities, then zero COM linear and angular momenta
+        mb_std = np.sqrt(kB * gas_vibration_temp / masses)[np.newaxis, :, np.newaxis]
+        velocities = variates['vibration'] * mb_std
+        com_v = np.einsum('a,nai->ni', masses, velocities) / total_gas_mass
+        velocities -= com_v[:, np.newaxis, :]
+
+        Ip, basis = gas.get_moments_of_inertia(vectors=True)
+        movable = Ip >= 1e-3  # same cutoff as sample_rotational_velocity
+        if not movable.all():
+            warnings.warn(f"Principal moments of inertia {Ip[~movable]} are too small, "
+                          "setting their angular velocities to 0.")
+        inv_Ip = np.where(movable, 1.0 / np.where(movable, Ip, 1.0), 0.0)
+        L = np.einsum('a,naj->nj', masses, np.cross(offset[np.newaxis], velocities))
+        omega = ((L @ basis.T) * inv_Ip) @ basis
+        velocities -= np.cross(omega[:, np.newaxis, :], offset[np.newaxis])
+
+        # Rotational velocities about the principal axes
+        spin_std = np.sqrt(kB * gas_rotation_temp * inv_Ip)  # sqrt(eV/(amu*Ang^2))
+        omega = (variates['spin'] * spin_std) @ basis
+        velocities += np.cross(omega[:, np.newaxis, :], offset[np.newaxis])
+
+        # Random orientation applied to positions and velocities alike
+        R = random_rotation_matrices(variates['rotation'])
+        positions = np.einsum('nij,aj->nai', R, offset)
+        velocities = np.einsum('nij,naj->nai', R, velocities)
+
+        # Translational velocities
+        mb_std = np.sqrt(kB * gas_translational_temp / total_gas_mass)  # sqrt(eV/amu)
+        velocities += variates['translation'][:, np.newaxis, :] * mb_std
+
+    # Replace COM z velocity with a Maxwell-Flux draw toward the slab
+    kBT_over_m = kB * gas_translational_temp / total_gas_mass  # eV/amu (unit of v**2)
+    com_vz_target = -mf_inverse_cdf(variates['flux'], kBT_over_m)
+    com_vz_current = velocities[:, :, 2] @ masses / total_gas_mass
+    velocities[:, :, 2] += (com_vz_target - com_vz_current)[:, np.newaxis]
+
+    return positions, velocities
+
+
+def top_site_types(slab, depth=1.0):
+    """
+    Labels the top-layer atoms of a slab as surface sites by element.
+
+    Args:
+        slab (ase.Atoms): The slab.
+        depth (float): Atoms within depth (Angstrom) of the highest atom count as top layer.
+
+    Returns:
+        dict: {'top_<symbol>': array of shape (n_sites, 2)} in direct (fractional) xy coordinates.
+    """
+    z = slab.get_positions()[:, 2]
+    top = z > z.max() - depth
+    symbols = np.array(slab.get_chemical_symbols())[top]
+    xy = slab.get_scaled_positions()[top, :2]
+    return {f'top_{symbol}': xy[symbols == symbol] for symbol in sorted(set(symbols))}
+
+
+def classify_impact_points(impact, sites, cell):
+    """
+    Assigns each impact point to the stratum of its nearest surface site
+    (periodic in x and y), i.e. the surface is split into Voronoi cells per site type.
+
+    Args:
+        impact (array): Impact points in direct xy coordinates, shape (N, 2).
+        sites (dict): {site type: direct xy coordinates of shape (n_sites, 2)}.
+        cell (array): Cell of the slab, only the xy block is used.
+
+    Returns:
+        numpy.ndarray: Stratum index (position in list(sites)) of each point.
+    """
+    labels = list(sites)
+    site_xy = np.vstack([np.atleast_2d(sites[label]) for label in labels])
+    site_stratum = np.repeat(np.arange(len(labels)), [len(np.atleast_2d(sites[label])) for label in labels])
+
+    d_frac = impact[:, np.newaxis, :] - site_xy[np.newaxis, :, :]
+    d_frac -= np.round(d_frac)
+    d_cart = d_frac @ np.asarray(cell)[:2, :2]
+    nearest = np.argmin(np.einsum('nsi,nsi->ns', d_cart, d_cart), axis=1)
+    return site_stratum[nearest]
+
+
+def draw_low_discrepancy_variates(n_samples, n_slab, n_gas, method='sobol', seed=None,
+                                  sites=None, cell=None, samples_per_stratum=None):
+    """
+    Drop-in replacement for draw_ensemble_variates where the orientation,
+    impact point, Maxwell-Flux quantile and the rotational/translational velocity
+    quantiles come from a scrambled Sobol or Latin hypercube design instead of
+    independent random numbers. Normal variates are obtained from the
+    low-discrepancy uniforms through the inverse normal CDF. The slab and
+    vibrational velocities are high dimensional and stay pseudo-random.
+
+    If sites is given, impact points are stratified by surface site type
+    (see classify_impact_points). Each stratum gets samples_per_stratum[k]
+    samples (default: as equal as possible) and a weight equal to the fraction
+    of the surface it covers. Per-sample weights (mean 1) undo the allocation,
+    so weighted averages over the ensemble are unbiased.
+
+    Args:
+        n_samples (int): Number of initial conditions.
+        n_slab (int): Number of slab atoms.
+        n_gas (int): Number of gas atoms.
+        method (str): 'sobol' or 'lhs'.
+        seed (int, optional): Master seed. A fresh one is drawn if None.
+        sites (dict, optional): {site type: direct xy coordinates}, e.g. from top_site_types.
+        cell (array, optional): Slab cell. Required with sites.
+        samples_per_stratum (list of int, optional): Allocation per site type. Must sum to n_samples.
+
+    Returns:
+        dict: Same keys as draw_ensemble_variates. With sites, also 'stratum' (N,)
+            site type of each sample, 'weight' (N,) and 'strata' {site type: weight}.
+    """
+    from scipy.stats import norm, qmc
+
+    variates = draw_ensemble_variates(n_samples, n_slab, n_gas, seed=seed)
+    rng = np.random.default_rng(np.random.SeedSequence([variates['seed'], 1]))
+
+    def engine(d):
+        if method == 'sobol':
+            return qmc.Sobol(d, scramble=True, seed=rng)
+        if method == 'lhs':
+            return qmc.LatinHypercube(d, seed=rng)
+        raise ValueError(f"Unknown sampling method '{method}'. Use 'sobol' or 'lhs'.")
+
+    # rotation (3), flux (1), spin (3), translation (3), impact (2)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', UserWarning)  # Sobol balance warning for n not a power of 2
+        u = engine(12).random(n_samples)
+    u = np.clip(u, 1e-12, 1 - 1e-12)
+    variates['rotation'] = u[:, 0:3]
+    variates['flux'] = u[:, 3]
+    variates['spin'] = norm.ppf(u[:, 4:7])
+    variates['translation'] = norm.ppf(u[:, 7:10])
+    variates['impact'] = u[:, 10:12]
+
+    if sites is None:
+        return variates
+
+    # --- Stratify impact points by site type ---
+    labels = list(sites)
+    n_strata = len(labels)
+    if samples_per_stratum is None:
+        samples_per_stratum = [n_samples // n_strata + (k < n_samples % n_strata) for k in range(n_strata)]
+    samples_per_stratum = np.asarray(samples_per_stratum)
+    if samples_per_stratum.sum() != n_samples:
+        raise ValueError("samples_per_stratum must sum to n_samples.")
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', UserWarning)
+        probe = qmc.Sobol(2, scramble=True, seed=rng).random_base2(14)
+        area = np.bincount(classify_impact_points(probe, sites, cell), minlength=n_strata) / len(probe)
+        if np.any((area == 0) & (samples_per_stratum > 0)):
+            raise ValueError(f"Site types {[labels[k] for k in np.flatnonzero(area == 0)]} cover no surface area.")
+
+        # Fill every stratum from one low-discrepancy stream of xy points
+        stream = engine(2)
+        impact = [np.empty((0, 2)) for _ in range(n_strata)]
+        while any(len(impact[k]) < samples_per_stratum[k] for k in range(n_strata)):
+            block = stream.random(1024)
+            strata = classify_impact_points(block, sites, cell)
+            for k in range(n_strata):
+                need = samples_per_stratum[k] - len(impact[k])
+                if need > 0:
+                    impact[k] = np.vstack([impact[k], block[strata == k][:need]])
+
+    stratum = np.repeat(np.arange(n_strata), samples_per_stratum)
+    variates['impact'] = np.vstack(impact)
+    variates['stratum'] = stratum
+    variates['weight'] = (area * n_samples / np.maximum(samples_per_stratum, 1))[stratum]
+    variates['strata'] = dict(zip(labels, area))
+    return variates
+
+
+def combine_slab_and_gas_ensemble(
+    n_samples,
+    slab_file="slab.vasp",
+    gas_file="gas.vasp",
+    output_file="slab_gas.traj",
+    separation=5.0,
+    slab_temp=300.0,
+    gas_vibration_temp=3000.0,
+    gas_rotation_temp=300.0,
+    gas_translational_temp=300.0,
+    seed=None,
+    sampler='random',
+    sites=None,
+    samples_per_stratum=None,
+):
+    """
+    Same as combine_slab_and_gas_with_velocities, but for n_samples initial
+    conditions at once. Slab and gas are read once, all random numbers are drawn
+    as arrays and the structures are streamed into a single ASE trajectory or,
+    if output_file ends with '.db', an ASE database.
+
+    Each structure records its sample index and the master seed ('sample' and
+    'seed' in atoms.info, or the 'sample' key and row.data['seed'] in the
+    database), so any single sample can be regenerated with
+    draw_ensemble_variates(..., seed=seed).
+
+    sampler='sobol' or 'lhs' uses draw_low_discrepancy_variates instead, so
+    averages over the ensemble converge with fewer samples. sites ({site type:
+    direct xy coordinates}, or 'top' for top_site_types(slab)) stratifies the
+    impact points by site type. Each structure then also records its 'stratum'
+    and 'weight', and the per-stratum weights are printed.
+    """
+    try:
+        slab = read(slab_file)
+        gas = read(gas_file)
+        print(f"Successfully read '{slab_file}' and '{gas_file}'.")
+    except FileNotFoundError as e:
+        print(f"Error: Could not find a required file. {e}")
+        return
+
+    if sampler == 'random':
+        if sites is not None:
+            raise ValueError("Stratification by site type needs sampler='sobol' or 'lhs'.")
+        variates = draw_ensemble_variates(n_samples, len(slab), len(gas), seed=seed)
+    else:
+        if isinstance(sites, str) and sites == 'top':
+            sites = top_site_types(slab)
+        variates = draw_low_discrepancy_variates(n_samples, len(slab), len(gas), method=sampler,
+                                                 seed=seed, sites=sites, cell=slab.get_cell(),
+                                                 samples_per_stratum=samples_per_stratum)
+    seed = variates['seed']
+    print(f"Drew {sampler} numbers for {n_samples} samples with seed {seed}.")
+    if 'strata' in variates:
+        counts = np.bincount(variates['stratum'], minlength=len(variates['strata']))
+        print("Per-stratum weights (fraction of surface area):")
+        for (label, weight), count in zip(variates['strata'].items(), counts):
+            print(f"  {label}: weight {weight:.4f}, {count} samples")
+
+    # --- Slab velocities (Maxwell-Boltzmann) ---
+    slab_std = np.sqrt(kB * slab_temp / slab.get_masses())[np.newaxis, :, np.newaxis]
+    slab_velocities = variates['slab'] * slab_std
+
+    # --- Gas orientations and velocities ---
+    gas_positions, gas_velocities = ensemble_gas_states(
+        gas, variates,
+        gas_vibration_temp=gas_vibration_temp,
+        gas_rotation_temp=gas_rotation_temp,
+        gas_translational_temp=gas_translational_temp,
+    )
+
+    # --- Place the gas separation above the slab at the impact points ---
+    max_z_slab = slab.get_positions()[:, 2].max()
+    impact = np.zeros((n_samples, 3))
+    impact[:, :2] = variates['impact']
+    impact = impact @ slab.cell
+    impact[:, 2] = max_z_slab + separation - gas_positions[:, :, 2].min(axis=1)
+    gas_positions += impact[:, np.newaxis, :]
+
+    # --- Combine and stream ---
+    template = slab + gas
+    template.set_cell(slab.get_cell())
+    template.set_pbc(slab.get_pbc())
+    slab_positions = slab.get_positions()
+
+    strata = list(variates.get('strata', {}))
+
+    def samples():
+        for i in range(n_samples):
+            combined = template.copy()
+            combined.set_positions(np.vstack([slab_positions, gas_positions[i]]))
+            combined.set_velocities(np.vstack([slab_velocities[i], gas_velocities[i]]))
+            keys = {'sample': i}
+            if strata:
+                keys['stratum'] = strata[variates['stratum'][i]]
+                keys['weight'] = float(variates['weight'][i])
+            yield combined, keys
+
+    if output_file.endswith('.db'):
+        with connect(output_file, append=False) as db:  # one transaction for all rows
+            for combined, keys in samples():
+                db.write(combined, data={'seed': seed}, **keys)
+    else:
+        with Trajectory(output_file, 'w') as traj:
+            for combined, keys in samples():
+                combined.info.update(keys, seed=seed)
+                traj.write(combined)
+    print(f"Successfully wrote {n_samples} combined systems with velocities to '{output_file}'.")
+
+    check_poscar_element_groups(gas_file)
+    check_poscar_element_groups(slab_file)
+
+
+#================================================================
+### Multiple gas molecules in one system
+
+def combine_slab_and_gases_with_velocities(
+    slab_file="slab.vasp",
+    gas_files=("gas.vasp",),
+    n_molecules=(10,),
+    output_file="slab_gases.vasp",
+    separation=5.0,
+    gas_region_height=10.0,
+    min_distance=2.0,
+    max_attempts=1000,
+    slab_temp=300.0,
+    gas_vibration_temp=3000.0,
+    gas_rotation_temp=300.0,
+    gas_translational_temp=300.0
+):
+    """
+    Like combine_slab_and_gas_with_velocities, but loads n_molecules[k] copies
+    of the molecule in gas_files[k] (mixed species allowed) into the region
+    from separation to separation + gas_region_height above the slab.
+
+    - Slab atoms get Maxwell-Boltzmann velocities at slab_temp.
+    - Every molecule is rotated and gets its own velocities from
+      initialize_gas_velocities (Maxwell-Boltzmann + Maxwell-Flux in z).
+    - Molecules are placed in random order at random positions. A position is
+      rejected if any of its atoms is closer than min_distance to an atom already
+      in the system. The check uses a PeriodicCellList, so loading hundreds of
+      molecules stays roughly linear in the number of atoms.
+    - Gas atoms come after the slab atoms in the output, grouped by element.
+    """
+    if len(gas_files) != len(n_molecules):
+        raise ValueError("gas_files and n_molecules must have the same length.")
+
+    try:
+        slab = read(slab_file)
+        gases = [read(gas_file) for gas_file in gas_files]
+        print(f"Successfully read '{slab_file}' and {list(gas_files)}.")
+    except FileNotFoundError as e:
+        print(f"Error: Could not find a required file. {e}")
+        return
+
+    # --- 1. Initialize Slab Velocities ---
+    MaxwellBoltzmannDistribution(slab, temperature_K=slab_temp)
+    print(f"Initialized slab velocities to {slab_temp} K.")
+
+    # --- 2. Define the Gas Region ---
+    z_lo = slab.get_positions()[:, 2].max() + separation
+    z_hi = z_lo + gas_region_height
+    if z_hi > slab.get_positions()[:, 2].min() + slab.cell[2, 2]:
+        warnings.warn("Gas region reaches past the periodic image of the slab bottom. "
+                      "Increase the vacuum or decrease gas_region_height.")
+
+    cell_list = PeriodicCellList(slab.get_cell(), slab.get_pbc(), min_distance)
+    cell_list.add(slab.get_positions())
+
+    # --- 3. Initialize and Place Each Molecule ---
+    species = np.random.permutation(np.repeat(np.arange(len(gases)), n_molecules))
+    gas_all = Atoms(cell=slab.get_cell(), pbc=slab.get_pbc())
+    n_trials = 0
+    for n_placed, k in enumerate(species):
+        gas = gases[k].copy()
+        initialize_gas_velocities(gas,
+                                  gas_vibration_temp=gas_vibration_temp,
+                                  gas_rotation_temp=gas_rotation_temp,
+                                  gas_translational_temp=gas_translational_temp,
+                                  verbose=False)
+        offset = gas.get_positions() - gas.get_center_of_mass()
+        z_min, z_max = offset[:, 2].min(), offset[:, 2].max()
+        if z_max - z_min > gas_region_height:
+            raise ValueError(f"Molecule from '{gas_files[k]}' does not fit in gas_region_height={gas_region_height}.")
+
+        for _ in range(max_attempts):
+            n_trials += 1
+            com = np.random.rand(3)
+            com[2] = 0
+            com = com @ slab.cell
+            com[2] = np.random.uniform(z_lo - z_min, z_hi - z_max)
+            trial = offset + com
+            if not cell_list.any_within(trial):
+                break
+        else:
+            raise RuntimeError(f"Could not place molecule {n_placed + 1} of {len(species)} "
+                               f"after {max_attempts} attempts. The gas region is too crowded.")
+
+        gas.set_positions(trial)
+        cell_list.add(trial)
+        gas_all += gas
+    print(f"Placed {len(species)} gas molecules {separation:.1f}-{separation + gas_region_height:.1f} Å "
+          f"above the slab ({len(species) / max(n_trials, 1):.1%} acceptance).")
+
+    # --- 4. Combine and Write ---
+    order = np.argsort(gas_all.get_chemical_symbols(), kind='stable')
+    combined_system = slab + gas_all[order]
+    combined_system.set_cell(slab.get_cell())
+    combined_system.set_pbc(slab.get_pbc())
+
+    write(output_file, combined_system, format='vasp', vasp5=True)
+    print(f"Successfully wrote combined system with velocities to '{output_file}'.")
+
+    for gas_file in gas_files:
+        check_poscar_element_groups(gas_file)
+    check_poscar_element_groups(slab_file)
+
+
 if __name__ == "__main__":
     combine_slab_and_gas_with_velocities()